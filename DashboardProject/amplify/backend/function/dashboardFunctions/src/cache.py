@@ -0,0 +1,36 @@
+import time
+import threading
+from collections import OrderedDict
+
+# In-process response cache--lives in the module, so it survives across warm invocations of the same container
+# Entries expire after ttl seconds; once maxEntries is reached the least recently used entry is evicted
+class ResponseCache:
+  def __init__(self, ttl = 60, maxEntries = 256):
+    self.ttl = ttl
+    self.maxEntries = maxEntries
+    self.entries = OrderedDict() # key --> (expires at, value)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or entry[0] < time.monotonic(): # Missing or expired
+        self.entries.pop(key, None)
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key) # Most recently used
+      self.hits += 1
+      return entry[1]
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = (time.monotonic() + self.ttl, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxEntries:
+        self.entries.popitem(last = False) # Evict the least recently used entry
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
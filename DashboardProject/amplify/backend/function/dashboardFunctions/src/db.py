@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import boto3
+
+# Database access for the metrics endpoint
+# Queries use :name parameters, which both the RDS Data API and sqlite3 understand, so the same SQL runs against
+# Aurora in Lambda and against a local SQLite stand-in (set LOCAL_SQLITE=<path to .db file>)
+
+rdsClient = None # Created lazily + reused across warm invocations
+sqliteConn = None
+
+# Convert a Data API field ({'stringValue': ...}, {'longValue': ...}, ...) into a plain python value
+def fieldValue(field):
+  if field.get('isNull'):
+    return None
+  for kind in ['stringValue', 'longValue', 'doubleValue', 'booleanValue']:
+    if kind in field:
+      return field[kind]
+  return None
+
+def queryDataAPI(sql, params):
+  global rdsClient
+  if rdsClient is None:
+    rdsClient = boto3.client('rds-data')
+  response = rdsClient.execute_statement(
+    resourceArn = os.environ['DB_CLUSTER_ARN'],
+    secretArn = os.environ['DB_SECRET_ARN'],
+    database = os.environ.get('DB_NAME', 'db'),
+    sql = sql,
+    parameters = [{'name': name, 'value': {'stringValue': str(val)}} for name, val in params.items()]
+  )
+  return [[fieldValue(f) for f in record] for record in response.get('records', [])]
+
+def querySQLite(sql, params):
+  global sqliteConn
+  if sqliteConn is None:
+    sqliteConn = sqlite3.connect(os.environ['LOCAL_SQLITE'])
+  return [list(row) for row in sqliteConn.execute(sql, params).fetchall()]
+
+# Run a read-only query + return its rows as lists
+def query(sql, params = None):
+  params = params or {}
+  if os.environ.get('LOCAL_SQLITE'):
+    return querySQLite(sql, params)
+  return queryDataAPI(sql, params)
+
+# Build a SQLite stand-in with the same QADailyRollup table the notebooks maintain (for running the handler locally)
+def makeLocalDatabase(path, rows):
+  conn = sqlite3.connect(path)
+  conn.execute('''
+    Create table if not exists QADailyRollup(
+      Date TEXT,
+      DeviceType TEXT not null default '',
+      BatchNumber TEXT not null default '',
+      Tester TEXT not null default '',
+      FunctionalTest TEXT not null default '',
+      FailureType TEXT not null default '',
+      Count INT not null default 0
+    )
+  ''')
+  conn.executemany('Insert into QADailyRollup values (?, ?, ?, ?, ?, ?, ?)', rows)
+  conn.commit()
+  conn.close()
@@ -1,15 +1,208 @@
+import base64
+import bisect
+import calendar
+import datetime as dt
+import gzip
+import hashlib
 import json
+import os
+import sys
 
-def handler(event, context):
-  print('received event:')
-  print(event)
-  
+import db
+from cache import ResponseCache
+
+# Aggregated QA metrics for the dashboard, answered from the QADailyRollup table (see the backend notebook)
+# Routes: GET /functions/<metric> or GET /functions?metric=<metric>
+#   passRate        ?start&end&deviceType
+#   failureTypes    ?start&end&deviceType
+#   failureOverTime ?start&end&segType(day/week/month/year)&x&deviceType
+# Dates are YYYY-MM-DD; ranges are [start, end)--same as getRange in the notebook
+
+corsHeaders = {
+  'Access-Control-Allow-Headers': '*',
+  'Access-Control-Allow-Origin': '*',
+  'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+  'Access-Control-Expose-Headers': 'ETag'
+}
+cacheTTL = int(os.environ.get('CACHE_TTL', 60)) # Seconds a computed metric is served without hitting the DB
+responseCache = ResponseCache(ttl = cacheTTL, maxEntries = int(os.environ.get('CACHE_MAX_ENTRIES', 256)))
+gzipMinBytes = 1024 # Smaller bodies aren't worth compressing
+maxSegments = 5000
+segTypes = ['day', 'week', 'month', 'year']
+
+class BadRequest(Exception):
+  pass
+
+def parseDate(params, name, required = False):
+  val = params.get(name)
+  if val is None:
+    if required:
+      raise BadRequest('Missing parameter: ' + name)
+    return None
+  try:
+    return dt.datetime.strptime(val, '%Y-%m-%d').date()
+  except ValueError:
+    raise BadRequest('Expected YYYY-MM-DD for ' + name)
+
+# Where clause + parameters for the common start/end/deviceType filters
+def rollupFilter(start, end, deviceType):
+  conds = ['Count > 0']
+  params = {}
+  if start is not None:
+    conds.append('Date >= :start')
+    params['start'] = start.isoformat()
+  if end is not None:
+    conds.append('Date < :end')
+    params['end'] = end.isoformat()
+  if deviceType is not None:
+    conds.append('DeviceType = :deviceType')
+    params['deviceType'] = deviceType
+  return 'where ' + ' and '.join(conds), params
+
+def passRate(params):
+  where, args = rollupFilter(parseDate(params, 'start'), parseDate(params, 'end'), params.get('deviceType'))
+  rows = db.query('Select FunctionalTest, Sum(Count) from QADailyRollup {} group by FunctionalTest'.format(where), args)
+  counts = {ft: int(n) for ft, n in rows}
+  total = sum(counts.values())
   return {
-      'statusCode': 200,
-      'headers': {
-          'Access-Control-Allow-Headers': '*',
-          'Access-Control-Allow-Origin': '*',
-          'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
-      },
-      'body': json.dumps('Hello from your new Amplify Python lambda!')
-  }
\ No newline at end of file
+    'total': total,
+    'pass': counts.get('Pass', 0),
+    'fail': total - counts.get('Pass', 0),
+    'passRate': counts.get('Pass', 0) / total * 100 if total else None
+  }
+
+# Share of ALL entries that fall under each failure type (like failureVisual, the non-failure bucket is left out)
+def failureTypes(params):
+  where, args = rollupFilter(parseDate(params, 'start'), parseDate(params, 'end'), params.get('deviceType'))
+  rows = db.query('Select FailureType, Sum(Count) from QADailyRollup {} group by FailureType'.format(where), args)
+  total = sum(int(n) for ft, n in rows)
+  types = [{'failureType': ft, 'count': int(n), 'percent': int(n) / total * 100} for ft, n in rows if ft not in ('', 'None', 'none')]
+  return {'total': total, 'failureTypes': sorted(types, key = lambda t: -t['count'])}
+
+# Move a date forward by x days/weeks/months/years (month ends clamp, like pandas DateOffset)
+def shiftDate(day, segType, x):
+  if segType == 'day':
+    return day + dt.timedelta(days = x)
+  if segType == 'week':
+    return day + dt.timedelta(weeks = x)
+  month = day.month - 1 + (x if segType == 'month' else 12 * x)
+  year = day.year + month // 12
+  month = month % 12 + 1
+  return day.replace(year = year, month = month, day = min(day.day, calendar.monthrange(year, month)[1]))
+
+def failureOverTime(params):
+  start = parseDate(params, 'start', True)
+  end = parseDate(params, 'end', True)
+  segType = params.get('segType', 'day')
+  if segType not in segTypes:
+    raise BadRequest('segType must be one of ' + ', '.join(segTypes))
+  try:
+    x = int(params.get('x', 1))
+  except ValueError:
+    raise BadRequest('x must be an integer')
+  if x < 1:
+    raise BadRequest('x must be at least 1')
+  edges = [start] # Segment starts from start up to end, plus end itself (the last segment is cut short at end)
+  while edges[-1] < end:
+    if len(edges) > maxSegments:
+      raise BadRequest('Too many segments--use a longer segType or a larger x')
+    edges.append(min(shiftDate(edges[-1], segType, x), end))
+  if len(edges) == 1:
+    return {'segments': []}
+
+  where, args = rollupFilter(start, edges[-1], params.get('deviceType'))
+  rows = db.query('Select Date, FunctionalTest, Sum(Count) from QADailyRollup {} group by Date, FunctionalTest'.format(where), args)
+  totals = [0] * (len(edges) - 1)
+  passes = [0] * (len(edges) - 1)
+  for day, ft, n in rows: # One row per day + result, so this loop is tiny next to the raw table
+    i = bisect.bisect_right(edges, dt.date.fromisoformat(str(day)[:10])) - 1
+    if 0 <= i < len(totals):
+      totals[i] += int(n)
+      if ft == 'Pass':
+        passes[i] += int(n)
+  return {'segments': [{
+    'startDate': edges[i].isoformat(),
+    'total': totals[i],
+    'pass': passes[i],
+    'failureRate': (totals[i] - passes[i]) / totals[i] * 100 if totals[i] else None
+  } for i in range(len(totals))]}
+
+routes = {
+  'passRate': passRate,
+  'failureTypes': failureTypes,
+  'failureOverTime': failureOverTime
+}
+
+def response(statusCode, body = None, headers = None):
+  res = {'statusCode': statusCode, 'headers': dict(corsHeaders, **(headers or {}))}
+  res['body'] = body if body is not None else ''
+  return res
+
+# Compute a metric (or reuse a cached copy) + return (json body, etag)
+def cachedMetric(route, params):
+  key = (route, tuple(sorted(params.items())))
+  entry = responseCache.get(key)
+  if entry is None:
+    body = json.dumps(routes[route](params), separators = (',', ':'))
+    entry = {'body': body, 'etag': '"' + hashlib.sha1(body.encode()).hexdigest() + '"', 'gzipped': None}
+    responseCache.put(key, entry)
+  return entry
+
+def handler(event, context):
+  print('received event:', event.get('httpMethod'), event.get('path'), event.get('queryStringParameters'))
+  if event.get('httpMethod') == 'OPTIONS':
+    return response(200)
+  params = dict(event.get('queryStringParameters') or {})
+  headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+  route = params.pop('metric', None) or (event.get('pathParameters') or {}).get('proxy') or (event.get('path') or '').rstrip('/').split('/')[-1]
+  if route not in routes:
+    return response(404, json.dumps({'error': 'Unknown metric', 'metrics': sorted(routes)}))
+
+  try:
+    entry = cachedMetric(route, params)
+  except BadRequest as e:
+    return response(400, json.dumps({'error': str(e)}))
+  except Exception as e: # DB errors still go back with the CORS headers so the browser can read them
+    print('Error computing', route, '-', repr(e))
+    return response(500, json.dumps({'error': 'Unable to compute ' + route}))
+
+  # gzip + identity bodies are different representations: each gets its own ETag, + Vary tells caches to key on Accept-Encoding
+  useGzip = 'gzip' in headers.get('accept-encoding', '') and len(entry['body']) >= gzipMinBytes
+  etag = entry['etag'][:-1] + '-gzip"' if useGzip else entry['etag']
+  cacheHeaders = {'ETag': etag, 'Cache-Control': 'max-age={}'.format(cacheTTL), 'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'}
+  if headers.get('if-none-match') == etag: # Client already has this version
+    return response(304, headers = cacheHeaders)
+  if useGzip:
+    if entry['gzipped'] is None: # Compress once per cached entry
+      entry['gzipped'] = base64.b64encode(gzip.compress(entry['body'].encode())).decode()
+    res = response(200, entry['gzipped'], dict(cacheHeaders, **{'Content-Encoding': 'gzip'}))
+    res['isBase64Encoded'] = True # API Gateway needs binary media types enabled to pass this through
+    return res
+  return response(200, entry['body'], cacheHeaders)
+
+# Stand-in for the Lambda context object when running locally
+class LocalContext:
+  function_name = 'dashboardFunctions-local'
+  aws_request_id = 'local'
+  def get_remaining_time_in_millis(self):
+    return 25000
+
+# Local run: python index.py [event.json]
+# Uses LOCAL_SQLITE (default: localQA.db next to this file), filled with sample rollup rows if it doesn't exist yet
+if __name__ == '__main__':
+  here = os.path.dirname(os.path.abspath(__file__))
+  path = os.environ.setdefault('LOCAL_SQLITE', os.path.join(here, 'localQA.db'))
+  if not os.path.exists(path):
+    day = dt.date(2021, 1, 1)
+    rows = []
+    for i in range(365):
+      for ft, failType, n in [('Pass', 'None', 40 + i % 7), ('Fail', ['Camera Issue', 'Lighting Issue', 'Other'][i % 3], 3 + i % 5)]:
+        rows.append(((day + dt.timedelta(days = i)).isoformat(), ['Mini', 'Catalina'][i % 2], 'B' + str(i // 30), 'Tester', ft, failType, n))
+    db.makeLocalDatabase(path, rows)
+  with open(sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, 'event.json')) as f:
+    event = json.load(f)
+  first = handler(event, LocalContext())
+  print(first['statusCode'], first['headers'].get('ETag'), first['body'][:300])
+  event['headers'] = dict(event.get('headers') or {}, **{'If-None-Match': first['headers'].get('ETag')})
+  second = handler(event, LocalContext()) # Warm repeat: served from the cache, 304 since the ETag matches
+  print(second['statusCode'], 'cache hits/misses:', responseCache.hits, responseCache.misses)
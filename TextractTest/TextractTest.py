@@ -1,7 +1,19 @@
 import boto3
 from collections import Counter
 import re
-import base64
+import os
+import json
+import gzip
+import hashlib
+import time
+import random
+import threading
+import concurrent.futures
+import enum
+import io
+import numpy as np
+from PIL import Image, ImageOps
+from botocore.exceptions import ClientError
 
 
 # Start up a client instance for textract
@@ -14,18 +26,196 @@ paths = ['catalina-4-19-21.jpg', 'catalina-10-5-21.jpg', 'indoor-5-17-21.jpg', '
 paths = ['catalina-4-19-21.jpg']
 
 
+# Image preprocessing
+# Phone photos of the sheets are far bigger than Textract needs (and close to the 5MB Bytes limit), so before OCR:
+# undo the EXIF rotation, scale down to targetDPI for a sheetInches wide page, convert to grayscale, optionally crop, re-encode as JPEG
+defaultPreprocess = {'targetDPI': 150, 'sheetInches': 11, 'grayscale': True, 'crop': None, 'quality': 75} # 150 DPI is Textract's recommended minimum
+
+def preprocessImage(path, targetDPI = 150, sheetInches = 11, grayscale = True, crop = None, quality = 75):
+    '''
+    targetDPI: resolution to keep, assuming the longest side of the photo spans sheetInches (11 = landscape letter)
+    crop: (left, top, right, bottom) as fractions of the image (ex: (0, 0.2, 1, 1) drops the top 20%)--the table region
+    quality: JPEG quality to re-encode at
+    Returns the new JPEG bytes
+    '''
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image) # Phones store rotation in EXIF--Textract reads the raw pixels
+        if crop is not None:
+            w, h = image.size
+            image = image.crop((int(crop[0] * w), int(crop[1] * h), int(crop[2] * w), int(crop[3] * h)))
+        maxSide = int(targetDPI * sheetInches)
+        if max(image.size) > maxSide:
+            image.thumbnail((maxSide, maxSide), Image.LANCZOS) # Keeps the aspect ratio
+        image = image.convert('L' if grayscale else 'RGB')
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality = quality, optimize = True)
+    return out.getvalue()
+
+# Sizes + time for one image (runs in a worker process)
+def preprocessOne(path, options):
+    start = time.time()
+    data = preprocessImage(path, **options)
+    return {'path': path, 'bytes': data, 'originalSize': os.path.getsize(path), 'size': len(data), 'seconds': time.time() - start}
+
+# Preprocess a batch of images across a process pool (resizing is CPU bound, so threads wouldn't help)
+def preprocessBatch(paths, processes = None, **options):
+    options = dict(defaultPreprocess, **options)
+    with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as pool:
+        return list(pool.map(preprocessOne, paths, [options] * len(paths)))
+
+# Textract response recorded from the console for a sample image, if there is one (ex: catalina-4-19-21/apiResponse.json)
+def recordedResponse(path):
+    recorded = os.path.join(os.path.splitext(path)[0], 'apiResponse.json')
+    if not os.path.exists(recorded):
+        return None
+    with open(recorded) as f:
+        return json.load(f)
+
+# Bytes saved + preprocessing time over the sample images, plus how much OCR accuracy changes:
+# the lines Textract finds in the preprocessed image are compared to the original's (recorded response if available)
+def benchmarkPreprocess(paths = None, textract = None, processes = None, **options):
+    paths = paths or sorted(p for p in os.listdir('.') if p.endswith('.jpg'))
+    start = time.time()
+    results = preprocessBatch(paths, processes, **options)
+    wall = time.time() - start
+    textract = textract or StubTextract(latency = 0)
+    stub = isinstance(textract, StubTextract)
+    recalls = []
+    for r in results:
+        baseline = None if stub else recordedResponse(r['path']) # A recorded response saves one real call per image
+        if baseline is None:
+            baseline = analyzeDocument(r['path'], textract, useCache = not stub) # Never cache stub output
+        processed = textract.detect_document_text(Document = {'Bytes': r['bytes']})
+        before = relevantLines(baseline)[0]
+        after = set(relevantLines(processed)[0])
+        r['lineRecall'] = sum(1 for line in before if line in after) / len(before) if before else 1.0
+        recalls.append(r['lineRecall'])
+        print('{}: {} KB --> {} KB ({}% smaller) in {}s, {}% of lines still found'.format(r['path'], r['originalSize'] // 1024, r['size'] // 1024, round(100 - r['size'] / r['originalSize'] * 100, 1), round(r['seconds'], 3), round(r['lineRecall'] * 100, 1)))
+    original = sum(r['originalSize'] for r in results)
+    saved = original - sum(r['size'] for r in results)
+    print('Total: saved {} KB of {} KB ({}%), {}s wall clock for {} images, average line recall {}%'.format(saved // 1024, original // 1024, round(saved / original * 100, 1), round(wall, 2), len(results), round(sum(recalls) / len(recalls) * 100, 1)))
+    if stub:
+        print('(Stub client--recall is only meaningful when a real Textract client is passed in)')
+    return results
+
+# On-disk cache of Textract responses
+# Keyed by a hash of the image bytes + the API + feature types, so the same sheet is only ever sent to Textract once
+# Responses are stored as gzipped JSON; once the cache passes maxBytes the least recently used responses are evicted
+# index.json remembers each image's (size, modified time) --> content hash, so unchanged images aren't even re-read
+class TextractCache:
+    def __init__(self, directory = 'textractCache', maxBytes = 500 * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.indexPath = os.path.join(directory, 'index.json')
+        self.index = {}
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as f:
+                self.index = json.load(f)
+        self.entries = {} # Cache file --> size, for the size limit
+        for root, dirs, names in os.walk(directory):
+            for name in names:
+                if name.endswith('.json.gz'):
+                    self.entries[os.path.join(root, name)] = os.path.getsize(os.path.join(root, name))
+        self.totalBytes = sum(self.entries.values())
+
+    # Content hash for an image--from the index when the file hasn't changed, otherwise read it (returns the bytes too)
+    def digest(self, path):
+        stat = os.stat(path)
+        known = self.index.get(os.path.abspath(path))
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2], None
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.index[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+            self.saveIndex()
+        return digest, data
+
+    def saveIndex(self):
+        os.makedirs(self.directory, exist_ok = True)
+        tmp = self.indexPath + '.tmp' + str(threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.indexPath)
+
+    def entryPath(self, digest, api, features):
+        key = hashlib.sha256('{}:{}:{}'.format(digest, api, ','.join(sorted(features or []))).encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.json.gz')
+
+    def get(self, entry):
+        try:
+            with gzip.open(entry, 'rt') as f:
+                response = json.load(f)
+        except (OSError, ValueError): # Missing (or a half written leftover)
+            with self.lock:
+                self.misses += 1
+            return None
+        os.utime(entry) # Touch--modified time doubles as the last used time for eviction
+        with self.lock:
+            self.hits += 1
+        return response
+
+    def put(self, entry, response):
+        os.makedirs(os.path.dirname(entry), exist_ok = True)
+        tmp = entry + '.tmp' + str(threading.get_ident())
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(response, f, default = str) # default: datetimes in ResponseMetadata etc.
+        os.replace(tmp, entry)
+        with self.lock:
+            self.totalBytes += os.path.getsize(entry) - self.entries.get(entry, 0)
+            self.entries[entry] = os.path.getsize(entry)
+            if self.totalBytes > self.maxBytes:
+                self.evict()
+
+    # Drop least recently used responses until back under 90% of maxBytes (called with the lock held)
+    def evict(self):
+        byAge = sorted(self.entries, key = lambda e: os.path.getmtime(e) if os.path.exists(e) else 0)
+        for e in byAge:
+            if self.totalBytes <= self.maxBytes * 0.9:
+                break
+            try:
+                os.remove(e)
+            except OSError:
+                pass
+            self.totalBytes -= self.entries.pop(e)
+
+textractCache = TextractCache()
+
+# Send an image to Textract (or serve the cached response)--the image is read at most once and passed straight through as bytes
+def cachedTextract(path, api, features = None, textract = None, useCache = True, refresh = False, preprocess = None):
+    data = None
+    if useCache:
+        digest, data = textractCache.digest(path)
+        variant = api if preprocess is None else api + json.dumps(preprocess, sort_keys = True) # Preprocessed images get their own entries
+        entry = textractCache.entryPath(digest, variant, features)
+        response = None if refresh else textractCache.get(entry)
+        if response is not None:
+            return response
+    if preprocess is not None:
+        data = preprocessImage(path, **preprocess)
+    elif data is None: # Not read yet (hash came from the index, or the cache is bypassed)
+        with open(path, 'rb') as f:
+            data = f.read()
+    kwargs = {'Document': {'Bytes': data}}
+    if features:
+        kwargs['FeatureTypes'] = features
+    response = getattr(textract or client, api)(**kwargs)
+    if useCache:
+        response.pop('ResponseMetadata', None) # Request ids etc. aren't worth keeping
+        textractCache.put(entry, response)
+    return response
+
 # Function to extract text from an image
-def analyzeDocument(path):
-    with open(path, 'rb') as raw_image: # Open the image from path
-        tempImage = raw_image.read() # Read in the image
-        # print('readImage:', tempImage)
-        byteImage = bytearray(tempImage) # Convert to a byte array
-        # print('byteImage', byteImage)
-        b64Str = base64.b64encode(tempImage)
-        decoded = base64.b64decode(b64Str)
-        print(decoded == tempImage) # Prints true --> ensures that the base64 module properly encodes + decodes an image
-        # print('base64string:', b64Str)
-    response = client.detect_document_text(Document = {'Bytes': byteImage}) # Call text detection method
+# textract: client to use (ex: StubTextract for offline runs)--defaults to the real one
+# useCache: False bypasses the cache completely (nothing read or stored--ex: benchmarks against the stub)
+# refresh: call Textract even if there's a cached response, then replace it
+# preprocess: options for preprocessImage (ex: defaultPreprocess) to shrink the image before sending it--None sends it as is
+def analyzeDocument(path, textract = None, useCache = True, refresh = False, preprocess = None):
+    return cachedTextract(path, 'detect_document_text', None, textract, useCache, refresh, preprocess) # Call text detection method
     # Bucket path lies below
     '''
     response = client.detect_document_text(
@@ -37,16 +227,11 @@ def analyzeDocument(path):
         }
     )
     '''
-    return response
 # analyzeDocument(paths[0])
 
 # Alternate method that uses the documnet analysis method (for "table" data)
-def extractText(path):
-    with open(path, 'rb') as raw_image:
-        tempImage = raw_image.read()
-        byteImage = bytearray(tempImage)
-    response = client.analyze_document(Document = {'Bytes': byteImage}, FeatureTypes = ['TABLES'])
-    return response
+def extractText(path, textract = None, useCache = True, refresh = False, preprocess = None):
+    return cachedTextract(path, 'analyze_document', ['TABLES'], textract, useCache, refresh, preprocess)
 
 
 '''
@@ -56,49 +241,246 @@ Intuition for the filter
     - Can remove any queries that don't have any digits or alphabetical characters since SN should contain both
 '''
 
-def testRelevant():
-    cleaned = []
-    allText = []
-    for path in paths: # Iterate across all paths
-        results = analyzeDocument(path) # Analyze the given image
-        blocks = results['Blocks'] # Extract only relevant information
-        tableData = [x['Text'] for x in blocks if x['BlockType'] == 'LINE'] # Only keep data that is a "line"
-        cleanedData = [] # Use a list b/c algorithm can produce duplicates
-        for t in tableData:
-            if len(t) > 8 and any(c.isdigit() for c in t) and any(c.isalpha() for c in t) and 'Date' not in t and t.count(' ') <= 1:
-                cleanedData.append(t) # Only include non-filtered out data
-        cleaned.append(cleanedData)
-        allText.append(tableData)
-    return (allText, cleaned)
-
-allText, serialNums = testRelevant()
+# Split a Textract response into (every LINE of text, the lines that look like serial numbers)
+def relevantLines(results):
+    blocks = results['Blocks'] # Extract only relevant information
+    tableData = [x['Text'] for x in blocks if x['BlockType'] == 'LINE'] # Only keep data that is a "line"
+    cleanedData = [] # Use a list b/c algorithm can produce duplicates
+    for t in tableData:
+        if len(t) > 8 and any(c.isdigit() for c in t) and any(c.isalpha() for c in t) and 'Date' not in t and t.count(' ') <= 1:
+            cleanedData.append(t) # Only include non-filtered out data
+    return tableData, cleanedData
+
+
+# Concurrent OCR
+# Each Textract call is a full network round trip, so many sheets are sent at once--capped at tps calls/second
+# (Textract's synchronous APIs have a per-account TPS quota) and retried with backoff when Textract throttles anyway
+
+throttleErrors = ('ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException')
+
+# Hands out evenly spaced call slots: at most tps calls start per second across every thread
+class RateLimiter:
+    def __init__(self, tps):
+        self.interval = 1.0 / tps if tps else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+# Stand-in Textract client for offline benchmarking: waits latency seconds per call + throttles a fraction of calls
+class StubTextract:
+    def __init__(self, latency = 0.5, throttleRate = 0.0, lines = None):
+        self.latency = latency
+        self.throttleRate = throttleRate
+        self.lines = lines or ['Date: 5/17/21', '38383JSBA0', '38383JSBA1', '38383JSBB0', 'Tester Zachary']
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def detect_document_text(self, Document, FeatureTypes = None):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if random.random() < self.throttleRate:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'DetectDocumentText')
+        return {'Blocks': [{'BlockType': 'LINE', 'Text': t} for t in self.lines]}
+
+    def analyze_document(self, Document, FeatureTypes):
+        return self.detect_document_text(Document, FeatureTypes)
+
+# Wraps a Textract client so every API call waits for a rate limiter slot (cache hits never reach it, so they're free)
+class LimitedTextract:
+    def __init__(self, textract, limiter):
+        self.textract = textract
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        method = getattr(self.textract, name)
+        def call(**kwargs):
+            self.limiter.wait()
+            return method(**kwargs)
+        return call
+
+# Run analyze(path) with retries on throttling: exponential backoff with full jitter
+def analyzeWithRetry(path, analyze, maxRetries = 6, baseDelay = 0.5):
+    for attempt in range(maxRetries + 1):
+        try:
+            return analyze(path)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in throttleErrors or attempt == maxRetries:
+                raise
+            time.sleep(random.uniform(0, baseDelay * 2 ** attempt))
+
+def analyzeConcurrently(paths, textract = None, maxWorkers = 8, tps = 5, analyze = analyzeDocument, useCache = True, preprocess = None):
+    '''
+    paths: images to OCR
+    textract: client to send them to (None --> the real client, StubTextract() for offline runs)
+    maxWorkers: requests in flight at once
+    tps: max Textract calls started per second (None for no limit)
+    analyze: analyzeDocument or extractText
+    useCache: False skips the response cache (cached sheets otherwise come back without a Textract call)
+    preprocess: preprocessImage options to shrink each image before it's sent (ex: defaultPreprocess)
+    Yields (path, response, error) as each image finishes--completion order, not input order
+    '''
+    limited = LimitedTextract(textract or client, RateLimiter(tps))
+    with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as pool:
+        futures = {pool.submit(analyzeWithRetry, path, lambda p: analyze(p, limited, useCache, preprocess = preprocess)): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+# Stream (path, all lines, likely serial numbers) as each sheet comes back
+def iterRelevant(paths = paths, textract = None, maxWorkers = 8, tps = 5):
+    for path, results, error in analyzeConcurrently(paths, textract, maxWorkers, tps):
+        if error is not None:
+            print('Unable to analyze', path)
+            print('Error:', error)
+            continue
+        tableData, cleanedData = relevantLines(results)
+        yield path, tableData, cleanedData
+
+# Returns (allText, cleaned, kept)--kept is the paths that were actually analyzed, lined up with allText/cleaned
+# (sheets that failed are left out, so index i of the results isn't necessarily paths[i])
+def testRelevant(paths = paths, textract = None, maxWorkers = 8, tps = 5):
+    found = {path: (tableData, cleanedData) for path, tableData, cleanedData in iterRelevant(paths, textract, maxWorkers, tps)}
+    kept = [path for path in paths if path in found] # Back in the same order as paths
+    allText = [found[path][0] for path in kept]
+    cleaned = [found[path][1] for path in kept]
+    return (allText, cleaned, kept)
+
+# Offline throughput check: serial loop vs the concurrent pipeline against the stub client
+def benchmarkOCR(n = 40, latency = 0.5, maxWorkers = 8, tps = 10, throttleRate = 0.05):
+    sample = [p for p in paths] * (n // len(paths) + 1)
+    sample = sample[:n]
+    stub = StubTextract(latency, throttleRate)
+    start = time.time()
+    for path, results, error in analyzeConcurrently(sample, stub, maxWorkers = 1, tps = None, useCache = False):
+        pass
+    serial = time.time() - start
+    start = time.time()
+    for path, results, error in analyzeConcurrently(sample, stub, maxWorkers, tps, useCache = False):
+        pass
+    parallel = time.time() - start
+    print('Serial: {} images in {}s ({} images/s)'.format(n, round(serial, 2), round(n / serial, 2)))
+    print('Concurrent ({} workers, {} TPS): {} images in {}s ({} images/s)'.format(maxWorkers, tps, n, round(parallel, 2), round(n / parallel, 2)))
+    return serial, parallel
 
 # Helper method to find the "majority" ruling
 def mostCommonElement(lst):
     temp = Counter(lst).most_common(1) # Get the most frequent element + its count
     return temp[0][0] # Return the most frequently appearing element
 
+# SN validation
+# Every SN gets a bit mask of the reasons it looks suspicious (0 = looks fine), computed for many sheets at once:
+# one pass to flatten the sheets, then NumPy counting (np.unique) for the per-sheet duplicate/prefix/length checks
+class SNFlag(enum.IntFlag):
+    PREFIX = 1 # Prefix differs from the sheet's most common (or the device's expected) prefix
+    LENGTH = 2 # Length differs from the sheet's most common (or the device's expected) length
+    DUPLICATE = 4 # Same SN appears more than once on the sheet
+    CHARACTERS = 8 # Contains something other than letters, digits + hyphens
+    PATTERN = 16 # Doesn't match the device's SN pattern
+
+badCharacters = re.compile(r'[^A-Za-z0-9-]') # Only possible characters in SN (note A-Z + a-z, not A-z, which lets [\]^_` through)
+
+# Per device rules--None means learn it from the sheet (most common value), like the original flagEntries
+# Keyed by the name each device's sheet files start with; sheets for devices without an entry fall back to 'default'
+# Values come from the recorded sheets (catalina-4-19-21, indoor-5-17-21, mini-26-4-21, mini-5-31-21 --> table-1.csv):
+# - Catalina + Indoor SNs are 16 characters starting with G8T1JX (ex: G8T1JX00114208BW, G8T1JX0011733TT0)
+# - Mini SNs are 16 characters shaped G8__9000 + 8 more (ex: G8V1900011329354, G8T1900012120SM3)--the 3rd/4th characters
+#   change between batches, so the prefix is still learned per sheet
+deviceRules = {
+    'default': {'prefixLength': 7, 'prefix': None, 'length': None, 'pattern': None},
+    'Catalina': {'prefixLength': 6, 'prefix': 'G8T1JX', 'length': 16, 'pattern': r'G8T1JX[0-9A-Z]{10}'},
+    'Indoor': {'prefixLength': 6, 'prefix': 'G8T1JX', 'length': 16, 'pattern': r'G8T1JX[0-9A-Z]{10}'},
+    'Mini': {'prefixLength': 7, 'prefix': None, 'length': 16, 'pattern': r'G8[0-9A-Z]{2}9000[0-9A-Z]{8}'}
+}
+
+# Guess the device from a sheet's file name (ex: mini-5-31-21.jpg --> Mini)
+def deviceFromPath(path):
+    name = os.path.basename(path).lower()
+    for device in deviceRules:
+        if device != 'default' and name.startswith(device.lower()):
+            return device
+    return 'default'
+
+# For each value: is it equal to its sheet's most common value? Ties go to whichever value appears first (same as Counter.most_common)
+def matchesSheetMode(sheetIds, values, nSheets):
+    keys, inverse = np.unique(values, return_inverse = True)
+    pairs = sheetIds * len(keys) + inverse # One code per (sheet, value)
+    codes, firstSeen, counts = np.unique(pairs, return_index = True, return_counts = True)
+    sheets = codes // len(keys)
+    order = np.lexsort((firstSeen, -counts, sheets)) # By sheet, then most common first, then first appearance
+    isFirst = np.r_[True, sheets[order][1:] != sheets[order][:-1]]
+    mode = np.full(nSheets, -1)
+    mode[sheets[order][isFirst]] = (codes % len(keys))[order][isFirst]
+    return mode[sheetIds] == inverse
+
+# Validate many sheets in one go--sheets: list of SN lists, devices: device name per sheet (None --> 'default')
+# Returns one np.uint8 array of SNFlag masks per sheet
+def validateSheets(sheets, devices = None):
+    devices = devices or ['default'] * len(sheets)
+    sizes = np.array([len(sheet) for sheet in sheets], dtype = np.int64)
+    sheetIds = np.repeat(np.arange(len(sheets)), sizes)
+    flat = [sn for sheet in sheets for sn in sheet]
+    masks = np.zeros(len(flat), dtype = np.uint8)
+    if not flat:
+        return [masks[:0] for sheet in sheets]
+    sns = np.array(flat, dtype = str)
+    lengths = np.char.str_len(sns)
+    masks[np.array([badCharacters.search(sn) is not None for sn in flat])] |= int(SNFlag.CHARACTERS)
+    snInverse = np.unique(sns, return_inverse = True)[1]
+    pairCounts = np.unique(sheetIds * (snInverse.max() + 1) + snInverse, return_inverse = True, return_counts = True)
+    masks[pairCounts[2][pairCounts[1]] > 1] |= int(SNFlag.DUPLICATE)
+
+    deviceOfSN = np.repeat(np.array([devices[i] or 'default' for i in range(len(sheets))], dtype = object), sizes)
+    for device in set(deviceOfSN):
+        rules = deviceRules.get(device, deviceRules['default'])
+        rows = np.flatnonzero(deviceOfSN == device) # Rules are per device, the checks stay vectorized within each device
+        prefixes = sns[rows].astype('<U' + str(rules['prefixLength'])) # Truncates to the first prefixLength characters
+        if rules['prefix'] is not None:
+            badPrefix = prefixes != rules['prefix']
+        else:
+            badPrefix = ~matchesSheetMode(sheetIds[rows], prefixes, len(sheets))
+        if rules['length'] is not None:
+            badLength = lengths[rows] != rules['length']
+        else:
+            badLength = ~matchesSheetMode(sheetIds[rows], lengths[rows], len(sheets))
+        masks[rows[badPrefix]] |= int(SNFlag.PREFIX)
+        masks[rows[badLength]] |= int(SNFlag.LENGTH)
+        if rules['pattern'] is not None:
+            pattern = re.compile(rules['pattern'])
+            masks[rows[np.array([pattern.fullmatch(flat[i]) is None for i in rows])]] |= int(SNFlag.PATTERN)
+    return np.split(masks, np.cumsum(sizes)[:-1])
+
+def validateSheet(lst, device = None):
+    return validateSheets([lst], [device])[0]
+
+# Readable version of a sheet's masks: [{'sn', 'reasons': ['PREFIX', ...]}]
+def describeFlags(lst, masks):
+    return [{'sn': sn, 'reasons': [flag.name for flag in SNFlag if mask & flag]} for sn, mask in zip(lst, masks)]
+
 # Entries that are deemed suspicious
-def flagEntries(lst):
-    prefixes = [s[:7] for s in lst] # Get the first 7 characters
-    lengths = [len(s) for s in lst] # Get the length of the sequence
-    isDuplicate = [lst.count(s) > 1 for s in lst] # Check to see if they're are duplicates
-    allowedChars = set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-') # Only possible characters in SN
-    containsIrreg = [bool(re.search('[^A-za-z0-9-]', s)) for s in lst] # Look for suspicious characters
-    mcp = mostCommonElement(prefixes) # Get most common prefix
-    mcl = mostCommonElement(lengths) # Get most commonly appearing length
-    suspicious = [prefixes[i] != mcp or lengths[i] != mcl or isDuplicate[i] or containsIrreg[i] for i in range(len(lst))] # Corresponds to suspicious entries
-    return suspicious
-
-# print(serialNums[0]) # Sanity Check
-
-# Getting the serial numbers for each batch along with their "suspicion based on criteria above"
-suspectLists = [flagEntries(lst) for lst in serialNums]
-for i in range(len(serialNums)):
-    pass
-    # print(serialNums[i])
-    # print(suspectLists[i], '\n\n')
-#print(flagEntries(serialNums[0]))
+def flagEntries(lst, device = None):
+    return [bool(mask) for mask in validateSheet(lst, device)] # Corresponds to suspicious entries
+
+if __name__ == '__main__': # Only call Textract when run as a script (importing just defines the helpers)
+    allText, serialNums, analyzed = testRelevant()
+    # print(serialNums[0]) # Sanity Check
+
+    # Getting the serial numbers for each batch along with their "suspicion based on criteria above"
+    suspectLists = validateSheets(serialNums, [deviceFromPath(path) for path in analyzed]) # Only the sheets that came back
+    for i in range(len(serialNums)):
+        pass
+        # print(serialNums[i])
+        # print(suspectLists[i], '\n\n')
+    #print(flagEntries(serialNums[0]))
 
 
 # Check to see what the "sloppy" data looks like
@@ -1,10 +1,12 @@
 # Test out functionality of dynamoDB
 import boto3
 from boto3.dynamodb.conditions import Key, Attr # Allow for conditions to be added when querying + scanning
+from dynamoRateLimiter import CapacityLimiter
 
 # Client + Resource instances
 ddb = boto3.resource('dynamodb') # Create a service resource
 client = boto3.client('dynamodb') # Create a client instance
+limiter = CapacityLimiter().attach(ddb, client) # Keep bulk loops within the table's 5 RCU/5 WCU instead of running into throttling
 
 
 # Helper method to print attributes of a given entry
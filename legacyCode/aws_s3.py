@@ -3,6 +3,14 @@
 import boto3
 import random
 import logging
+import os
+import time
+import hashlib
+import sqlite3
+import queue
+import threading
+import concurrent.futures
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
 # Core functionalities
@@ -15,8 +23,172 @@ def getBucketNames():
 
 # Helper method to get all the objects w/in a bucket
 def getBucketObjectNames(bucket):
-	objects = list(s3.Bucket(bucket).objects.all()) # Get a list of the existing objects in a bucket
-	return [o.key for o in objects] # Print out all the existing keys
+	return [o['Key'] for o in iterObjects(bucket)] # Keys only--object summaries are never all held at once
+
+# Listing
+# Generators over list_objects_v2 pages, so a bucket with millions of objects streams through in 1000 object pages
+
+# Yield {'Key', 'Size', 'ETag', 'LastModified'} for every object under prefix
+# delimiter: only list direct children (ex: '/' stops at the next folder level--see listPrefixes for the folders themselves)
+# startAfter: only keys that sort after this one (ex: the newest key already seen, for date ordered keys)
+def iterObjects(bucket, prefix = '', delimiter = None, startAfter = None):
+	kwargs = {'Bucket': bucket, 'Prefix': prefix}
+	if delimiter:
+		kwargs['Delimiter'] = delimiter
+	if startAfter:
+		kwargs['StartAfter'] = startAfter
+	for page in s3_client.get_paginator('list_objects_v2').paginate(**kwargs):
+		for obj in page.get('Contents', []):
+			yield {'Key': obj['Key'], 'Size': obj['Size'], 'ETag': obj['ETag'].strip('"'), 'LastModified': obj['LastModified']}
+
+# Yield the 'folders' directly under prefix (ex: listPrefixes('qa-sheets') --> '2021-05/', '2021-06/', ...)
+def listPrefixes(bucket, prefix = '', delimiter = '/'):
+	for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket = bucket, Prefix = prefix, Delimiter = delimiter):
+		for common in page.get('CommonPrefixes', []):
+			yield common['Prefix']
+
+# List several independent prefixes at once + yield objects as their pages arrive (order across prefixes isn't kept)
+# prefixes: None lists every folder directly under prefix in parallel (plus the objects sitting at that level)
+def iterObjectsParallel(bucket, prefixes = None, prefix = '', maxWorkers = 8, delimiter = '/'):
+	if prefixes is None:
+		yield from iterObjects(bucket, prefix, delimiter) # Objects that aren't inside any sub-folder
+		prefixes = list(listPrefixes(bucket, prefix, delimiter))
+	results = queue.Queue(maxsize = maxWorkers * 4) # Bounded so listing can't run far ahead of the consumer
+	stop = threading.Event()
+	done = object() # Marks one prefix as finished
+	# Hand an item to the consumer--gives up once the consumer has stopped, so a worker never blocks forever on a full queue
+	def offer(item):
+		while not stop.is_set():
+			try:
+				results.put(item, timeout = 0.5)
+				return True
+			except queue.Full:
+				continue
+		return False
+	def listOne(p):
+		try:
+			for obj in iterObjects(bucket, p):
+				if not offer(obj):
+					return
+		except Exception as e:
+			offer(e)
+		offer(done)
+	with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as pool:
+		for p in prefixes:
+			pool.submit(listOne, p)
+		try:
+			remaining = len(prefixes)
+			while remaining:
+				obj = results.get()
+				if obj is done:
+					remaining -= 1
+				elif isinstance(obj, Exception):
+					raise obj
+				else:
+					yield obj
+		finally:
+			stop.set() # Consumer stopped early (or hit an error)--let the workers wind down
+			while True: # Unblock anyone waiting on a full queue
+				try:
+					results.get_nowait()
+				except queue.Empty:
+					break
+
+# Local manifest
+# SQLite copy of a bucket's listing (key, size, etag, last modified) so later questions don't need to re-list the bucket
+# processedAt tracks which objects have been OCR'd--cleared automatically when an object's content changes
+
+manifestPath = 's3Manifest.db'
+
+def openManifest(path = manifestPath):
+	conn = sqlite3.connect(path)
+	conn.execute('''
+		Create table if not exists Objects(
+			Bucket TEXT not null,
+			Key TEXT not null,
+			Size INTEGER,
+			ETag TEXT,
+			LastModified TEXT,
+			SyncedAt REAL,
+			ProcessedAt REAL,
+			primary key (Bucket, Key)
+		)
+	''')
+	return conn
+
+def syncManifest(bucket, prefixes = None, prefix = '', path = manifestPath, appendOnly = False, maxWorkers = 8):
+	'''
+	bucket: bucket to mirror
+	prefixes: only refresh these prefixes (ex: ['2021-05/'])--None refreshes everything under prefix, listing its folders in parallel
+	appendOnly: keys are never rewritten/deleted + sort by upload order (ex: date prefixed), so only list past the newest key we have
+	Returns {'listed', 'added', 'changed', 'removed', 'seconds'}
+	'''
+	start = time.time()
+	conn = openManifest(path)
+	syncedAt = time.time()
+	scopes = prefixes if prefixes is not None else [prefix]
+	known = {}
+	for scope in scopes:
+		known.update((key, (size, etag, lastModified)) for key, size, etag, lastModified in conn.execute('Select Key, Size, ETag, LastModified from Objects where Bucket = ? and substr(Key, 1, ?) = ?', (bucket, len(scope), scope)))
+	if appendOnly:
+		objects = (obj for scope in scopes for obj in iterObjects(bucket, scope, startAfter = max((k for k in known if k.startswith(scope)), default = None)))
+	elif prefixes is None:
+		objects = iterObjectsParallel(bucket, prefix = prefix, maxWorkers = maxWorkers)
+	else:
+		objects = iterObjectsParallel(bucket, prefixes = prefixes, maxWorkers = maxWorkers, delimiter = None)
+	stats = {'listed': 0, 'added': 0, 'changed': 0, 'removed': 0}
+	batch = []
+	def flush():
+		conn.executemany('''
+			Insert into Objects(Bucket, Key, Size, ETag, LastModified, SyncedAt) values (?, ?, ?, ?, ?, ?)
+			on conflict(Bucket, Key) do update set
+				ProcessedAt = case when ETag = excluded.ETag then ProcessedAt else null end,
+				Size = excluded.Size, ETag = excluded.ETag, LastModified = excluded.LastModified, SyncedAt = excluded.SyncedAt
+		''', batch)
+		batch.clear()
+	listed = set()
+	for obj in objects:
+		stats['listed'] += 1
+		listed.add(obj['Key'])
+		row = (obj['Size'], obj['ETag'], obj['LastModified'].isoformat())
+		old = known.get(obj['Key'])
+		if old == row: # Unchanged--no write
+			continue
+		stats['added' if old is None else 'changed'] += 1
+		batch.append((bucket, obj['Key']) + row + (syncedAt,))
+		if len(batch) >= 1000:
+			flush()
+	flush()
+	if not appendOnly: # Anything in the refreshed prefixes that wasn't listed this time is gone from the bucket
+		gone = [(bucket, key) for key in known if key not in listed]
+		conn.executemany('Delete from Objects where Bucket = ? and Key = ?', gone)
+		stats['removed'] += len(gone)
+	conn.commit()
+	conn.close()
+	stats['seconds'] = time.time() - start
+	print('Manifest for {}: {} listed, {} added, {} changed, {} removed in {} seconds'.format(bucket, stats['listed'], stats['added'], stats['changed'], stats['removed'], round(stats['seconds'], 2)))
+	return stats
+
+# Keys under prefix according to the manifest (no S3 calls)
+def manifestKeys(bucket, prefix = '', path = manifestPath):
+	conn = openManifest(path)
+	keys = [key for (key,) in conn.execute('Select Key from Objects where Bucket = ? and substr(Key, 1, ?) = ? order by Key', (bucket, len(prefix), prefix))]
+	conn.close()
+	return keys
+
+# Record that these objects have been OCR'd
+def markProcessed(bucket, keys, path = manifestPath):
+	conn = openManifest(path)
+	conn.executemany('Update Objects set ProcessedAt = ? where Bucket = ? and Key = ?', [(time.time(), bucket, key) for key in keys])
+	conn.commit()
+	conn.close()
+
+# Ex: unprocessedKeys('qa-sheets', '2021-05/') --> sheets from May 2021 that haven't been OCR'd yet
+def unprocessedKeys(bucket, prefix = '', path = manifestPath):
+	conn = openManifest(path)
+	keys = [key for (key,) in conn.execute('Select Key from Objects where Bucket = ? and substr(Key, 1, ?) = ? and ProcessedAt is null order by Key', (bucket, len(prefix), prefix))]
+	conn.close()
+	return keys
 
 # Helper method to allow generic upload of a file to an s3 bucket
 def uploadFile(filePath, bucket, objectName = None):
@@ -34,6 +206,91 @@ def uploadFile(filePath, bucket, objectName = None):
 		return False # Indicate that the operation was unsuccessful
 	return True # Able to successfully upload
 
+# Directory uploads
+# Multipart kicks in above multipart_threshold; each part is multipart_chunksize (also used to predict multipart ETags below)
+defaultTransferConfig = TransferConfig(
+	multipart_threshold = 16 * 1024 * 1024,
+	multipart_chunksize = 16 * 1024 * 1024,
+	max_concurrency = 4, # Threads per file--on top of the uploadDirectory workers
+	use_threads = True
+)
+
+# Read a file once + compute both its S3 style ETag (for the given part size) and its sha256
+# Single part uploads have ETag = md5 of the file; multipart ones are md5 of the part md5s + '-<number of parts>'
+def localChecksums(path, config = defaultTransferConfig):
+	size = os.path.getsize(path)
+	sha = hashlib.sha256()
+	partDigests = []
+	with open(path, 'rb') as f:
+		while True:
+			chunk = f.read(config.multipart_chunksize)
+			if not chunk:
+				break
+			sha.update(chunk)
+			partDigests.append(hashlib.md5(chunk).digest())
+	if size < config.multipart_threshold:
+		etag = partDigests[0].hex() if partDigests else hashlib.md5(b'').hexdigest()
+	else:
+		etag = hashlib.md5(b''.join(partDigests)).hexdigest() + '-' + str(len(partDigests))
+	return etag, sha.hexdigest()
+
+# Size + ETag of every object under a prefix, from a single paginated listing (instead of one head_object per file)
+def remoteObjects(bucket, prefix):
+	found = {}
+	for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket = bucket, Prefix = prefix):
+		for obj in page.get('Contents', []):
+			found[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+	return found
+
+# Upload one file unless the object already there has the same content
+def uploadIfChanged(path, bucket, key, remote, config, force = False):
+	result = {'path': path, 'key': key, 'bytes': os.path.getsize(path), 'status': 'uploaded', 'seconds': 0.0}
+	start = time.time()
+	try:
+		etag, sha = localChecksums(path, config)
+		if not force and key in remote and remote[key][0] == result['bytes']: # Size matches--check the content
+			if remote[key][1] == etag:
+				result['status'] = 'skipped'
+			elif s3_client.head_object(Bucket = bucket, Key = key).get('Metadata', {}).get('sha256') == sha: # Uploaded with a different part size
+				result['status'] = 'skipped'
+		if result['status'] == 'uploaded':
+			s3_client.upload_file(path, bucket, key, Config = config, ExtraArgs = {'Metadata': {'sha256': sha}})
+	except (ClientError, OSError) as e:
+		logging.error(e)
+		result['status'] = 'failed'
+		result['error'] = str(e)
+	result['seconds'] = time.time() - start
+	return result
+
+def uploadDirectory(localDir, bucket, prefix = '', maxWorkers = 8, config = defaultTransferConfig, force = False):
+	'''
+	localDir: directory to upload (walked recursively)
+	bucket: name of the bucket to upload into
+	prefix: key prefix--files land at prefix + their path relative to localDir (with / separators)
+	maxWorkers: number of files uploading at once
+	config: TransferConfig controlling multipart threshold/chunk size + per file threads
+	force: upload everything, even files that are already up to date
+	Returns {'files': per-file results, 'uploaded', 'skipped', 'failed', 'bytes', 'seconds', 'MBps'}
+	'''
+	if prefix and not prefix.endswith('/'):
+		prefix += '/'
+	files = []
+	for root, dirs, names in os.walk(localDir):
+		for name in names:
+			path = os.path.join(root, name)
+			files.append((path, prefix + os.path.relpath(path, localDir).replace(os.sep, '/')))
+	start = time.time()
+	remote = remoteObjects(bucket, prefix)
+	with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as pool: # boto3 clients are thread safe
+		results = list(pool.map(lambda f: uploadIfChanged(f[0], bucket, f[1], remote, config, force), files))
+	summary = {'files': results, 'seconds': time.time() - start}
+	for status in ['uploaded', 'skipped', 'failed']:
+		summary[status] = sum(1 for r in results if r['status'] == status)
+	summary['bytes'] = sum(r['bytes'] for r in results if r['status'] == 'uploaded')
+	summary['MBps'] = summary['bytes'] / 1e6 / summary['seconds'] if summary['seconds'] else 0
+	print('Uploaded {} files ({} MB at {} MB/s), skipped {} unchanged, {} failed'.format(summary['uploaded'], round(summary['bytes'] / 1e6, 2), round(summary['MBps'], 2), summary['skipped'], summary['failed']))
+	return summary
+
 def createBuckets(n = 1): # Create n new buckets
 	for i in range(10, n + 10):
 		#print('iteration:', i)
@@ -41,36 +298,37 @@ def createBuckets(n = 1): # Create n new buckets
 		#print('worked at: ', i)
 # for bucket in s3.buckets.all(): # Get all the names of the buckets
 # 	print('bucket name:', bucket.name)
-createBuckets(5)
-print(getBucketNames()) # Get the names of all buckets at our disposal
+if __name__ == '__main__': # Only run the demo when executed directly (keeps the helpers importable, ex: under moto)
+	createBuckets(5)
+	print(getBucketNames()) # Get the names of all buckets at our disposal
 
-# Add objects to these buckets
-bucketNames = ['ztzhu1' + str(i) for i in range(5)]
-filePathsToAdd = ['s' + str(i) + '.xlsx' for i in range(1, 6)]
-print(filePathsToAdd)
-print(bucketNames)
+	# Add objects to these buckets
+	bucketNames = ['ztzhu1' + str(i) for i in range(5)]
+	filePathsToAdd = ['s' + str(i) + '.xlsx' for i in range(1, 6)]
+	print(filePathsToAdd)
+	print(bucketNames)
 
-tempBucket = s3.Bucket('ztzhu10')
+	tempBucket = s3.Bucket('ztzhu10')
 
-#s3_client.upload_file(filePathsToAdd[0], 'ztzhu10', 's1.xlsx')
+	#s3_client.upload_file(filePathsToAdd[0], 'ztzhu10', 's1.xlsx')
 
-# Upload a .xlsx file to each of the original buckets
-for i in range(5):
-	uploadFile(filePathsToAdd[i], bucketNames[i])
+	# Upload a .xlsx file to each of the original buckets
+	for i in range(5):
+		uploadFile(filePathsToAdd[i], bucketNames[i])
 
-# Print out the objects contained in each bucket
-for bucket in bucketNames:
-	print('bucket:', bucket, 'obj names:', getBucketObjectNames(bucket))
+	# Print out the objects contained in each bucket
+	for bucket in bucketNames:
+		print('bucket:', bucket, 'obj names:', getBucketObjectNames(bucket))
 
-# Using the sample test data
-specialBucket = s3.create_bucket(Bucket = 'ztzhu-special') # Create a bucket to experiment with the given data
-uploadSpecial = uploadFile('sampleTestLog.xlsx', 'ztzhu-special') # Upload the test data to this bucket
-print('uploaded test data?', uploadSpecial)
+	# Using the sample test data
+	specialBucket = s3.create_bucket(Bucket = 'ztzhu-special') # Create a bucket to experiment with the given data
+	uploadSpecial = uploadFile('sampleTestLog.xlsx', 'ztzhu-special') # Upload the test data to this bucket
+	print('uploaded test data?', uploadSpecial)
 
 
-# Downloading data from a bucket
-downloadSpecial = s3_client.download_file('ztzhu-special', 'sampleTestLog.xlsx', 'sampleTestLog-copy.xlsx') # Parameters: bucket name (FROM), object name (FROM), file name (SAVED TO)
-print('able to download?', downloadSpecial)
+	# Downloading data from a bucket
+	downloadSpecial = s3_client.download_file('ztzhu-special', 'sampleTestLog.xlsx', 'sampleTestLog-copy.xlsx') # Parameters: bucket name (FROM), object name (FROM), file name (SAVED TO)
+	print('able to download?', downloadSpecial)
 
 
 
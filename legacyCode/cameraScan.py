@@ -1,57 +1,392 @@
 # Program to go from a camera scna to QR code read
 
 import cv2 # Module to allow for reading image/camera/video input
+import argparse
+import os
+import time
+import queue
+import threading
+import random
+import datetime
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+from collections import OrderedDict
 from pyzbar import pyzbar
-from pyzbar.pyzbar import decode
 
 
 # Source Code: https://www.youtube.com/watch?v=IOhZqmSrjlE&ab_channel=KostadinRistovski
 
-def test1():
-	cap = cv2.VideoCapture(0)
-	cap.set(3, 100) # Set width (setting 3) to 100 pixels
-	cap.set(4, 100) # Set height (setting 4) to 100 pixels
-
-	camera = True # Make sure we're operating with camera mode
-	while camera: # Ensure that we're in camera mode
-		success, frame = cap.read() # Read in the camera results
-		for code in decode(frame):
-			print(code.type) # Indicate what kind of code was generated
-			print(code.data.decode('utf-8')) # Decode the actually results of the camera scan
-			print(code.data) # Decode the actually results of the camera scan
-		cv2.imshow('Testing-code-scan', frame) # What the hell does this do?
-		cv2.waitKey(1) # Delay 100ms before the next scan
-
-test1()
-
-def read_barcodes(frame):
-    barcodes = pyzbar.decode(frame)
-    for barcode in barcodes:
-        x, y , w, h = barcode.rect
-        #1
-        barcode_info = barcode.data.decode('utf-8')
+# Draw the boxes + text for codes found in a frame (codes: list of (text, (x, y, w, h)) in frame coordinates)
+def drawBarcodes(frame, codes):
+    for barcode_info, (x, y, w, h) in codes:
         cv2.rectangle(frame, (x, y),(x+w, y+h), (0, 255, 0), 2)
-        
-        #2
         font = cv2.FONT_HERSHEY_DUPLEX
         cv2.putText(frame, barcode_info, (x + 6, y - 6), font, 2.0, (255, 255, 255), 1)
-        #3
-        with open("barcode_result.txt", mode ='w') as file:
-            file.write("Recognized Barcode:" + barcode_info)
     return frame
 
-def main():
-    #1
-    camera = cv2.VideoCapture(0)
-    ret, frame = camera.read()
-    #2
-    while ret:
-        ret, frame = camera.read()
-        frame = read_barcodes(frame)
-        cv2.imshow('Barcode/QR code reader', frame)
-        if cv2.waitKey(1) & 0xFF == 27:
-            break
-    #3
-    camera.release()
-    cv2.destroyAllWindows()
 
+# Scan pipeline
+# capture thread --> bounded frame queue --> decode workers --> result queue --> sinks (on the calling thread)
+# When the decoders fall behind a live camera, the oldest waiting frame is dropped so results stay current
+
+imageTypes = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+# Yield frames from a camera index, a video file or a directory of images
+def frameSource(source):
+    if isinstance(source, str) and os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(imageTypes):
+                frame = cv2.imread(os.path.join(source, name))
+                if frame is not None:
+                    yield frame
+        return
+    capture = cv2.VideoCapture(source)
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                return
+            yield frame
+    finally:
+        capture.release()
+
+# Shrink a frame before decoding: optional ROI crop (x, y, w, h), grayscale, downscale
+# Returns the image to decode + how to map its coordinates back onto the full frame
+def preprocessFrame(frame, scale = 0.5, roi = None):
+    offset = (0, 0)
+    if roi is not None:
+        x, y, w, h = roi
+        frame = frame[y:y + h, x:x + w]
+        offset = (x, y)
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) # zbar only looks at intensity anyway
+    if scale != 1:
+        frame = cv2.resize(frame, None, fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
+    return frame, offset
+
+# Writes every detection to a text file through one buffered handle (instead of reopening it per barcode)
+class FileSink:
+    def __init__(self, path = 'barcode_result.txt'):
+        self.file = open(path, 'a', buffering = 64 * 1024)
+
+    def write(self, result):
+        for barcode_info, rect in result['codes']:
+            self.file.write('Recognized Barcode:' + barcode_info + '\n')
+
+    def close(self):
+        self.file.close()
+
+# Scan --> database
+# The same code is seen in dozens of frames a second, so the sink debounces: a serial only counts again once it's been
+# out of view for longer than window seconds. New serials are queued + written in batches from a background thread
+# (when batchSize are waiting or the oldest has waited flushInterval seconds), so many stations can scan at full frame rate
+
+# Write serials into the DynamoDB QAResults table (same item layout as makeItem in dynamoDB-ex2.py)
+# Serials that already have an entry are left alone--a rescan shouldn't overwrite test results
+# A BatchGetItem lookup skips the ones known up front, the rest go out as PartiQL INSERTs through BatchExecuteStatement
+# (25 per request). An INSERT fails with DuplicateItem when the key already exists, so two stations racing on the same
+# serial can't overwrite each other
+class DynamoWriter:
+    def __init__(self, tableName = 'QAResults', defaults = None, maxRetries = 8):
+        '''
+        defaults: fields every new entry starts with (ex: {'Tester': 'Zachary', 'BatchNumber': 5})
+        maxRetries: resends of throttled statements/unprocessed keys before giving up on them
+        '''
+        self.table = boto3.resource('dynamodb', endpoint_url = os.environ.get('DYNAMODB_ENDPOINT')).Table(tableName)
+        self.client = self.table.meta.client
+        self.defaults = dict({'Tester': 'Scanner', 'BatchNumber': 0, 'FunctionTest': 'Pending', 'LogMessage': 'Added by scan'}, **(defaults or {}))
+        self.maxRetries = maxRetries
+        self.serializer = TypeSerializer()
+
+    # Jittered exponential backoff before a resend
+    def backoff(self, attempt):
+        time.sleep(random.uniform(0, min(5, 0.05 * 2 ** attempt)))
+
+    # Serials (out of these) that are already in the table--BatchGetItem takes 100 keys at a time
+    # Returns (found, unresolved): unresolved keys were still unprocessed after maxRetries resends
+    def existing(self, serials):
+        found = set()
+        unresolved = []
+        for i in range(0, len(serials), 100):
+            request = {self.table.name: {'Keys': [{'SerialNumber': sn} for sn in serials[i:i + 100]], 'ProjectionExpression': 'SerialNumber'}}
+            for attempt in range(self.maxRetries + 1):
+                if attempt:
+                    self.backoff(attempt)
+                response = self.client.batch_get_item(RequestItems = request)
+                found.update(item['SerialNumber'] for item in response['Responses'].get(self.table.name, []))
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+            if request:
+                unresolved += [key['SerialNumber'] for key in request[self.table.name]['Keys']]
+        return found, unresolved
+
+    # INSERT statement (+ parameters) for one new serial
+    def insertStatement(self, sn, date):
+        item = dict(self.defaults, SerialNumber = sn, Date = date, Month = date[:7])
+        values = ', '.join("'{}': ?".format(field) for field in item)
+        return {'Statement': 'INSERT INTO "{}" VALUE {{{}}}'.format(self.table.name, values),
+                'Parameters': [self.serializer.serialize(v) for v in item.values()]}
+
+    # Send one group (<= 25) of INSERTs, resending throttled ones--returns how many were written
+    def insertGroup(self, group):
+        pending = group # [(serial, statement)] still to send
+        written = 0
+        for attempt in range(self.maxRetries + 1):
+            if attempt:
+                self.backoff(attempt)
+            try:
+                responses = self.client.batch_execute_statement(Statements = [statement for sn, statement in pending])['Responses']
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded'):
+                    raise
+                continue
+            retry = []
+            for (sn, statement), response in zip(pending, responses): # Responses line up with the statements sent
+                error = response.get('Error')
+                if error is None:
+                    written += 1
+                elif error.get('Code') == 'DuplicateItem': # Someone else added it since the lookup
+                    continue
+                elif error.get('Code') in ('ProvisionedThroughputExceeded', 'ThrottlingError', 'RequestLimitExceeded'):
+                    retry.append((sn, statement))
+                else: # Anything else gets the batch retried by DatabaseSink (already written serials come back as duplicates)
+                    raise RuntimeError('Insert of {} failed: {} {}'.format(sn, error.get('Code'), error.get('Message')))
+            pending = retry
+            if not pending:
+                return written
+        raise RuntimeError('{} serials still throttled after {} retries'.format(len(pending), self.maxRetries))
+
+    def __call__(self, serials):
+        found, unresolved = self.existing(serials) # Unresolved serials just go through the INSERT--it's conditional anyway
+        date = datetime.datetime.today().strftime('%Y-%m-%d')
+        statements = [(sn, self.insertStatement(sn, date)) for sn in serials if sn not in found]
+        return sum(self.insertGroup(statements[i:i + 25]) for i in range(0, len(statements), 25))
+
+class DatabaseSink:
+    def __init__(self, writeBatch = None, window = 5.0, maxRecent = 10000, batchSize = 25, flushInterval = 2.0, maxRetries = 5):
+        '''
+        writeBatch: function taking a list of new serials (defaults to DynamoWriter())
+        window: seconds a serial has to be out of view before another sighting counts as a new scan
+        maxRecent: serials remembered for debouncing (least recently seen are forgotten first)
+        batchSize/flushInterval: flush when this many serials are waiting, or the oldest has waited this long
+        maxRetries: attempts per batch before it's given up on (and printed)
+        '''
+        self.writeBatch = writeBatch or DynamoWriter()
+        self.window = window
+        self.maxRecent = maxRecent
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxRetries = maxRetries
+        self.recent = OrderedDict() # serial --> last time seen
+        self.pending = [] # (serial, time queued)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.stats = {'sightings': 0, 'queued': 0, 'flushes': 0, 'written': 0, 'retries': 0, 'failed': []}
+        self.thread = threading.Thread(target = self.flushLoop, daemon = True)
+        self.thread.start()
+
+    # Called with every decoded frame
+    def write(self, result):
+        now = time.monotonic()
+        with self.cond:
+            for barcode_info, rect in result['codes']:
+                self.stats['sightings'] += 1
+                lastSeen = self.recent.pop(barcode_info, None)
+                self.recent[barcode_info] = now # Most recently seen goes to the end
+                if lastSeen is not None and now - lastSeen <= self.window:
+                    continue # Same code still in view
+                self.pending.append((barcode_info, now))
+                self.stats['queued'] += 1
+            while len(self.recent) > self.maxRecent:
+                self.recent.popitem(last = False)
+            if len(self.pending) >= self.batchSize:
+                self.cond.notify()
+
+    # Background thread: wait for a full batch or for the oldest serial to hit flushInterval, then write
+    def flushLoop(self):
+        while True:
+            with self.cond:
+                while not self.closed and len(self.pending) < self.batchSize:
+                    timeout = self.pending[0][1] + self.flushInterval - time.monotonic() if self.pending else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.cond.wait(timeout)
+                batch = [sn for sn, queued in self.pending[:self.batchSize]]
+                del self.pending[:self.batchSize]
+                if not batch and self.closed:
+                    return
+            if batch:
+                self.flush(list(dict.fromkeys(batch))) # Same serial can be queued twice if it left + came back within one batch
+
+    def flush(self, batch):
+        for attempt in range(self.maxRetries):
+            try:
+                written = self.writeBatch(batch)
+                self.stats['flushes'] += 1
+                self.stats['written'] += written if isinstance(written, int) else len(batch)
+                return
+            except Exception as e:
+                self.stats['retries'] += 1
+                print('Unable to write scanned serials (attempt {}):'.format(attempt + 1), e)
+                time.sleep(random.uniform(0, min(30, 0.5 * 2 ** attempt))) # Jittered exponential backoff
+        self.stats['failed'] += batch
+        print('Gave up on', len(batch), 'scanned serials:', batch)
+
+    # Flush whatever is still waiting + stop the background thread
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        print('Scan sink: {sightings} sightings, {queued} new scans, {written} written in {flushes} batches'.format(**self.stats))
+
+class ScanPipeline:
+    def __init__(self, source = 0, workers = 2, scale = 0.5, roi = None, sinks = None, queueSize = None, skipFrames = None, show = False):
+        '''
+        source: camera index, video file or directory of images
+        workers: number of decode threads (pyzbar releases the GIL while decoding)
+        scale/roi: preprocessing before decode (see preprocessFrame)
+        sinks: objects with write(result) + close()--results arrive one at a time on the thread calling run()
+        queueSize: frames allowed to wait for a decoder (defaults to 2 per worker)
+        skipFrames: drop the oldest waiting frame when decoders fall behind--defaults to True for cameras, False for files
+        show: draw the codes + display each decoded frame (needs a display)
+        '''
+        self.source = source
+        self.workers = workers
+        self.scale = scale
+        self.roi = roi
+        self.sinks = sinks if sinks is not None else [FileSink()]
+        self.frames = queue.Queue(maxsize = queueSize or 2 * workers)
+        self.results = queue.Queue()
+        self.skipFrames = isinstance(source, int) if skipFrames is None else skipFrames
+        self.show = show
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {'captured': 0, 'dropped': 0, 'decoded': 0, 'codes': 0, 'waitSeconds': 0.0, 'preprocessSeconds': 0.0, 'decodeSeconds': 0.0, 'latencySeconds': 0.0}
+
+    # Capture thread: read frames as fast as the source gives them
+    def capture(self):
+        try:
+            for frameId, frame in enumerate(frameSource(self.source)):
+                if self.stop.is_set():
+                    break
+                item = (frameId, time.monotonic(), frame)
+                if self.skipFrames:
+                    while True:
+                        try:
+                            self.frames.put_nowait(item)
+                            break
+                        except queue.Full: # Decoders are behind--throw away the oldest frame instead of falling further behind
+                            try:
+                                self.frames.get_nowait()
+                                with self.lock:
+                                    self.stats['dropped'] += 1
+                            except queue.Empty:
+                                pass
+                else:
+                    self.frames.put(item)
+                with self.lock:
+                    self.stats['captured'] += 1
+        finally:
+            for i in range(self.workers):
+                self.frames.put(None) # One stop marker per worker
+
+    # Decode worker: preprocess + decode frames, map the boxes back to the full frame
+    def decodeFrames(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                self.results.put(None)
+                return
+            frameId, captured, frame = item
+            started = time.monotonic()
+            small, (dx, dy) = preprocessFrame(frame, self.scale, self.roi)
+            decodeStart = time.monotonic()
+            codes = []
+            for barcode in pyzbar.decode(small):
+                x, y, w, h = barcode.rect
+                rect = (int(x / self.scale) + dx, int(y / self.scale) + dy, int(w / self.scale), int(h / self.scale))
+                codes.append((barcode.data.decode('utf-8'), rect))
+            finished = time.monotonic()
+            with self.lock:
+                self.stats['waitSeconds'] += started - captured
+                self.stats['preprocessSeconds'] += decodeStart - started
+                self.stats['decodeSeconds'] += finished - decodeStart
+            self.results.put({'frameId': frameId, 'captured': captured, 'codes': codes, 'frame': frame if self.show else None})
+
+    # Run until the source runs out (or Esc is pressed when showing frames); returns the stats
+    def run(self):
+        start = time.monotonic()
+        threads = [threading.Thread(target = self.capture, daemon = True)]
+        threads += [threading.Thread(target = self.decodeFrames, daemon = True) for i in range(self.workers)]
+        for t in threads:
+            t.start()
+        running = self.workers
+        try:
+            while running:
+                result = self.results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                for sink in self.sinks:
+                    sink.write(result)
+                self.stats['decoded'] += 1
+                self.stats['codes'] += len(result['codes'])
+                self.stats['latencySeconds'] += time.monotonic() - result['captured']
+                if self.show:
+                    cv2.imshow('Barcode/QR code reader', drawBarcodes(result['frame'], result['codes']))
+                    if cv2.waitKey(1) & 0xFF == 27:
+                        break
+        finally:
+            self.stop.set()
+            while True: # Unblock the capture thread if it's waiting on a full queue
+                try:
+                    self.frames.get_nowait()
+                except queue.Empty:
+                    break
+            for sink in self.sinks:
+                sink.close()
+            if self.show:
+                cv2.destroyAllWindows()
+        return self.report(time.monotonic() - start)
+
+    def report(self, seconds):
+        s = self.stats
+        decoded = max(s['decoded'], 1)
+        summary = {
+            'seconds': seconds,
+            'fps': s['decoded'] / seconds if seconds else 0,
+            'captured': s['captured'],
+            'dropped': s['dropped'],
+            'decoded': s['decoded'],
+            'codes': s['codes'],
+            'queueWaitMs': s['waitSeconds'] / decoded * 1000,
+            'preprocessMs': s['preprocessSeconds'] / decoded * 1000,
+            'decodeMs': s['decodeSeconds'] / decoded * 1000,
+            'endToEndMs': s['latencySeconds'] / decoded * 1000
+        }
+        print('Decoded {decoded} of {captured} frames ({dropped} dropped) at {fps:.1f} FPS, {codes} codes found'.format(**summary))
+        print('Per frame: {queueWaitMs:.1f}ms queued, {preprocessMs:.1f}ms preprocess, {decodeMs:.1f}ms decode, {endToEndMs:.1f}ms capture to sink'.format(**summary))
+        return summary
+
+# Headless throughput check over a video file or image directory for a few worker counts
+def benchmarkScan(source, workerCounts = (1, 2, 4), scale = 0.5, roi = None):
+    return {workers: ScanPipeline(source, workers, scale, roi, sinks = []).run() for workers in workerCounts}
+
+def main(source = 0, toDatabase = False, workers = 2, scale = 0.5, show = True):
+    # Capture, decode + display on separate threads--the pipeline releases the camera + closes the window when done
+    sinks = [FileSink()] + ([DatabaseSink()] if toDatabase else []) # toDatabase: also add new serials to QAResults
+    return ScanPipeline(source, workers, scale, sinks = sinks, show = show).run()
+
+# python cameraScan.py [camera index | video file | image directory] [--database] [--workers N] [--scale S] [--no-show]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Scan barcodes/QR codes from a camera, video or directory of images')
+    parser.add_argument('source', nargs = '?', default = '0', help = 'camera index (default 0), video file or image directory')
+    parser.add_argument('--database', action = 'store_true', help = 'also add new serials to the QAResults table')
+    parser.add_argument('--workers', type = int, default = 2, help = 'decode threads')
+    parser.add_argument('--scale', type = float, default = 0.5, help = 'downscale factor before decoding')
+    parser.add_argument('--no-show', dest = 'show', action = 'store_false', help = "don't open a preview window (ex: headless runs over a video)")
+    args = parser.parse_args()
+    main(int(args.source) if args.source.isdigit() else args.source, args.database, args.workers, args.scale, args.show)
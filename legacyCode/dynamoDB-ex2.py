@@ -2,12 +2,48 @@ import boto3
 from boto3.dynamodb.conditions import Key, Attr # Allow for conditions to be added when querying + scanning
 import datetime
 import random
+import os
+import time
+import json
+import threading
+import concurrent.futures
+from decimal import Decimal
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeSerializer
+from dynamoRateLimiter import CapacityLimiter
 
 
 
 # Bread + Butter of dynamoDB
-client = boto3.client('dynamodb') # Create a client instance
-ddb = boto3.resource('dynamodb') # Create a resource instance
+endpoint = os.environ.get('DYNAMODB_ENDPOINT') # Ex: http://localhost:8000 for DynamoDB Local--None means the real service
+client = boto3.client('dynamodb', endpoint_url = endpoint) # Create a client instance
+ddb = boto3.resource('dynamodb', endpoint_url = endpoint) # Create a resource instance
+limiter = CapacityLimiter().attach(client, ddb) # Pace every call to the table's provisioned throughput (see dynamoRateLimiter.py)
+
+# Global secondary indexes: name --> (HASH attribute, RANGE attribute or None)
+# Month (YYYY-MM) is written alongside Date so date ranges can be answered by querying one partition per month
+attributeTypes = {'SerialNumber': 'S', 'Date': 'S', 'Month': 'S', 'BatchNumber': 'N', 'Tester': 'S'}
+indexes = {
+	'DateIndex': ('Date', None),
+	'MonthDateIndex': ('Month', 'Date'),
+	'BatchDateIndex': ('BatchNumber', 'Date'),
+	'TesterDateIndex': ('Tester', 'Date')
+}
+indexThroughput = {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+
+# Build the GlobalSecondaryIndexes description for one index
+def indexSpec(name):
+	hashKey, rangeKey = indexes[name]
+	keySchema = [{'AttributeName': hashKey, 'KeyType': 'HASH'}]
+	if rangeKey is not None:
+		keySchema.append({'AttributeName': rangeKey, 'KeyType': 'RANGE'})
+	return {
+		'IndexName': name,
+		'KeySchema': keySchema,
+		'Projection': {'ProjectionType': 'ALL'}, # Queries on the index return whole entries
+		'ProvisionedThroughput': indexThroughput
+	}
 
 # Helper method to create a table if one doesn't already exist
 def createTable(tableName):
@@ -22,12 +58,8 @@ def createTable(tableName):
 				},
 			],
 			# Describes all the attributes and the corresponding data type that they are: S-String, N-number, B-binary
-			AttributeDefinitions = [
-				{
-					'AttributeName': 'SerialNumber',
-					'AttributeType': 'S'
-				}
-			],
+			AttributeDefinitions = [{'AttributeName': name, 'AttributeType': t} for name, t in attributeTypes.items()],
+			GlobalSecondaryIndexes = [indexSpec(name) for name in indexes],
 			# Provide throughput settings for a given table
 			ProvisionedThroughput = {
 				'ReadCapacityUnits': 5, # Allowed 5 consistent reads/second
@@ -40,43 +72,210 @@ def createTable(tableName):
 		print('Table with name ' + tableName + ' already exists')
 		table = ddb.Table(tableName) # Reference an existing table
 		print('Able to successfully reference the table')
+		addIndexes(table)
 	return table
 
+# Add any missing indexes to an existing table (DynamoDB only allows one new index per update_table call)
+def addIndexes(table):
+	existing = set(i['IndexName'] for i in (table.global_secondary_indexes or []))
+	for name in indexes:
+		if name in existing:
+			continue
+		usedAttributes = [a for a in indexes[name] if a is not None]
+		table.update(
+			AttributeDefinitions = [{'AttributeName': a, 'AttributeType': attributeTypes[a]} for a in usedAttributes],
+			GlobalSecondaryIndexUpdates = [{'Create': indexSpec(name)}]
+		)
+		table.meta.client.get_waiter('table_exists').wait(TableName = table.name)
+		waitForIndex(table, name)
+		print('Added index', name)
+
+# Poll the table description until the named index exists, is ACTIVE and has finished backfilling
+def waitForIndex(table, name, delay = 5):
+	while True:
+		table.reload() # The cached description predates the update, so always refresh before checking
+		index = next((i for i in (table.global_secondary_indexes or []) if i['IndexName'] == name), None)
+		if index is not None and index['IndexStatus'] == 'ACTIVE' and not index.get('Backfilling', False):
+			return index
+		time.sleep(delay)
+
 table = createTable('QAResults')
 
 # Get string version of today's date
 def getDate():
 	return datetime.datetime.today().strftime('%Y-%m-%d') # YYYY-MM-DD
 
-# Helper method to add an entry to the table (based off of table name)
-def addEntry(tableName, SN, batchNum, tester = 'Zachary', functionTest = 'Pass', commentary = 'Default Message'):
-	item = {
-		'SerialNumber': {'S': SN}, # Need to specify the data type in addition to the actual entry
-		'Tester': {'S': tester},
-		'BatchNumber': {'N': str(batchNum)},
-		'FunctionTest': {'S': functionTest},
-		'LogMessage': {'S': commentary},
-		'Date': {'S': getDate()}
-		
+# Build a complete entry (resource format--plain python values) so it can be written in one go
+def makeItem(SN, batchNum, tester = 'Zachary', functionTest = 'Pass', commentary = 'Default Message', date = None):
+	date = date or getDate()
+	return {
+		'SerialNumber': SN,
+		'Tester': tester,
+		'BatchNumber': batchNum,
+		'FunctionTest': functionTest,
+		'LogMessage': commentary,
+		'Date': date,
+		'Month': date[:7] # Partition key of MonthDateIndex
 	}
-	client.put_item(
-		TableName = tableName,
-		Item = item
-	)
+
+# Helper method to add an entry to the table (based off of table name)
+def addEntry(tableName, SN, batchNum, tester = 'Zachary', functionTest = 'Pass', commentary = 'Default Message', date = None):
+	ddb.Table(tableName).put_item(Item = makeItem(SN, batchNum, tester, functionTest, commentary, date))
+	entryCache.invalidate(SN)
+
+# Bulk writes: BatchWriteItem takes up to 25 puts per request
+batchWriteSize = 25
+throttleErrors = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+# Full jitter exponential backoff: random wait between 0 and base * 2^attempt (capped)
+def backoff(attempt, base = 0.05, cap = 5):
+	time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+# Write one chunk (<= 25 items), retrying whatever DynamoDB hands back as unprocessed
+# Returns (items written, capacity units consumed, items that never went through)
+def writeChunk(tableName, items, maxRetries = 8):
+	requests = [{'PutRequest': {'Item': item}} for item in items]
+	consumed = 0.0
+	for attempt in range(maxRetries + 1):
+		try:
+			response = table.meta.client.batch_write_item(RequestItems = {tableName: requests}, ReturnConsumedCapacity = 'INDEXES') # INDEXES splits table vs index units for the limiter
+		except ClientError as e:
+			if e.response['Error']['Code'] not in throttleErrors: # Not a capacity problem--retrying won't help
+				raise
+			backoff(attempt)
+			continue
+		consumed += sum(c.get('CapacityUnits', 0) for c in response.get('ConsumedCapacity', []))
+		requests = response.get('UnprocessedItems', {}).get(tableName, [])
+		if not requests:
+			return len(items), consumed, []
+		backoff(attempt)
+	failed = [r['PutRequest']['Item'] for r in requests]
+	return len(items) - len(failed), consumed, failed
+
+'''
+items: complete entries (see makeItem)--every record is written exactly once, no follow up update_item
+threads: number of chunks in flight at once
+Returns {'written', 'failed' (items that still weren't processed after every retry), 'seconds', 'itemsPerSec', 'wcu'}
+'''
+def batchWriteItems(items, tableName = 'QAResults', threads = 4, maxRetries = 8):
+	deduped = {item['SerialNumber']: item for item in items} # A batch can't hold the same key twice--last write wins like put_item
+	items = list(deduped.values())
+	entryCache.invalidate(*deduped)
+	chunks = [items[i:i + batchWriteSize] for i in range(0, len(items), batchWriteSize)]
+	result = {'written': 0, 'failed': [], 'wcu': 0.0}
+	start = time.time()
+	with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as pool:
+		for written, consumed, failed in pool.map(lambda chunk: writeChunk(tableName, chunk, maxRetries), chunks):
+			result['written'] += written
+			result['wcu'] += consumed
+			result['failed'] += failed
+	result['seconds'] = time.time() - start
+	result['itemsPerSec'] = result['written'] / result['seconds'] if result['seconds'] else 0
+	print('Wrote', result['written'], 'items in', round(result['seconds'], 2), 'seconds ({} items/sec, {} WCU)'.format(round(result['itemsPerSec'], 1), result['wcu']))
+	if result['failed']:
+		print('Unable to write', len(result['failed']), 'items after', maxRetries, 'retries')
+	return result
+
+# Process-local read-through cache for entries (keyed by serial number)
+# Entries expire after ttl seconds; past maxEntries the least recently used one is evicted
+# Serials that don't exist are cached too (as None), so repeated lookups of unknown serials stay cheap
+class EntryCache:
+	def __init__(self, ttl = 300, maxEntries = 10000):
+		self.ttl = ttl
+		self.maxEntries = maxEntries
+		self.entries = OrderedDict() # SN --> (expires at, item or None)
+		self.lock = threading.Lock() # Lookups can come from several threads
+		self.hits = 0
+		self.misses = 0
+
+	# Returns (found, item)--found is False on a miss or an expired entry
+	def get(self, SN):
+		with self.lock:
+			entry = self.entries.get(SN)
+			if entry is None or entry[0] < time.monotonic():
+				self.entries.pop(SN, None)
+				self.misses += 1
+				return False, None
+			self.entries.move_to_end(SN) # Most recently used
+			self.hits += 1
+			return True, (dict(entry[1]) if entry[1] is not None else None) # Copy so callers can't modify the cached item
+
+	def put(self, SN, item):
+		with self.lock:
+			self.entries[SN] = (time.monotonic() + self.ttl, item)
+			self.entries.move_to_end(SN)
+			while len(self.entries) > self.maxEntries:
+				self.entries.popitem(last = False)
+
+	# Drop entries that were just written (add/edit/delete) so the next read goes to the table
+	def invalidate(self, *serials):
+		with self.lock:
+			for SN in serials:
+				self.entries.pop(SN, None)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {'hits': self.hits, 'misses': self.misses, 'hitRate': self.hits / lookups if lookups else None, 'size': len(self.entries)}
+
+entryCache = EntryCache()
 
 # Retrieve a given entry--lookup by SN
-def getEntry(SN):
+def getEntry(SN, useCache = True):
+	if useCache:
+		found, item = entryCache.get(SN)
+		if found:
+			return item
 	try:
 		item = table.get_item(
 			Key = { # Can fetch an item based off of its combined partition + sort key (since here we don't necessarily have a unique partition)
 				'SerialNumber': SN
 			}
-		)['Item']
+		).get('Item')
+		entryCache.put(SN, item)
 		return item
 	except Exception as e:
 		print('Unable to retrieve entry:', SN)
 		return None
 
+# BatchGetItem takes up to 100 keys per request
+batchGetSize = 100
+
+# Fetch one group of keys, retrying whatever comes back in UnprocessedKeys
+def getChunk(serials, maxRetries = 8):
+	request = {table.name: {'Keys': [{'SerialNumber': SN} for SN in serials]}}
+	found = {}
+	for attempt in range(maxRetries + 1):
+		response = table.meta.client.batch_get_item(RequestItems = request)
+		for item in response['Responses'].get(table.name, []):
+			found[item['SerialNumber']] = item
+		request = response.get('UnprocessedKeys')
+		if not request:
+			return found
+		backoff(attempt)
+	raise RuntimeError('Unable to fetch {} keys after {} retries'.format(len(request[table.name]['Keys']), maxRetries))
+
+# Retrieve many entries at once--returns a list lined up with serials (None for serials that aren't in the table)
+def getEntries(serials, useCache = True):
+	results = {}
+	toFetch = []
+	for SN in dict.fromkeys(serials): # Unique serials, first occurrence order
+		found, item = entryCache.get(SN) if useCache else (False, None)
+		if found:
+			results[SN] = item
+		else:
+			toFetch.append(SN)
+	for i in range(0, len(toFetch), batchGetSize):
+		chunk = toFetch[i:i + batchGetSize]
+		fetched = getChunk(chunk)
+		for SN in chunk:
+			results[SN] = fetched.get(SN)
+			entryCache.put(SN, results[SN])
+	return [results[SN] for SN in serials]
+
 
 
 # Populate the table
@@ -96,11 +295,12 @@ passMessage = 'No issue encountered. Completed Functional Tests!'
 def populateEntries(n = 1):
 	try:
 		prefix = '38383JSBC'
+		items = []
 		for i in range(n):
-			tester = random.choice(possibleTesters),
 			res = 'Pass' if i % 4 != 0 else 'Fail'
 			logMessage = random.choice(possibleIssueMessages) if res == 'Fail' else  passMessage
-			addEntry('QAResults', prefix + str(i), 2, possibleTesters[i % 3], res, logMessage)
+			items.append(makeItem(prefix + str(i), 2, possibleTesters[i % 3], res, logMessage))
+		batchWriteItems(items)
 	except Exception as e:
 		print('Exception in populateEntries:', e)
 
@@ -113,6 +313,7 @@ def deleteEntry(SN): # Again, serial number serves as the Primary Key
 				'SerialNumber': SN
 			}
 		)
+		entryCache.invalidate(SN)
 	except Exception as e:
 		print('Unable to delete entry')
 
@@ -126,19 +327,22 @@ def testDeleteEntry():
 def editEntry(SN, field, newVal):
 	try:
 		updateExpr = 'SET #attrName = :val1' # Specify what field we actually want to change
+		names = {'#attrName': field}
+		values = {':val1': newVal} # Set the field equal to the new value
+		if field == 'Date': # Keep Month in sync so the entry moves to the right MonthDateIndex partition
+			updateExpr += ', #month = :month'
+			names['#month'] = 'Month'
+			values[':month'] = newVal[:7]
 		#print('Update Expression:', updateExpr)
 		table.update_item(
 			Key = { # Again, need to specify identifiers to get the right entry from the table
 				'SerialNumber': SN # # Placeholder for the attribute name--otherwise can't modify any field with special characters (like space or hypen)
 			},
 			UpdateExpression = updateExpr,
-			ExpressionAttributeNames = {
-				'#attrName': field
-			},
-			ExpressionAttributeValues = {
-				':val1': newVal # Set the field equal to the new value
-			}
+			ExpressionAttributeNames = names,
+			ExpressionAttributeValues = values
 		)
+		entryCache.invalidate(SN)
 	except Exception as e:
 		print('Unable to edit an entry')
 		print('Exception:', e)
@@ -162,6 +366,7 @@ def deleteField(SN, field):
 				'#attrName': field
 			}
 		)
+		entryCache.invalidate(SN)
 		print('Able to successfully delete a field!')
 	except Exception as e:
 		print('Unable to delete field from an entry')
@@ -176,15 +381,35 @@ def testDeleteField():
 
 
 # Basic Querying/Scanning Functions
+# Every helper below is a generator that follows LastEvaluatedKey, so results past the first 1MB page aren't dropped
+
+# Yield every item from a query/scan call, page after page
+def paginate(method, **kwargs):
+	while True:
+		response = method(**kwargs)
+		for item in response['Items']:
+			yield item
+		if 'LastEvaluatedKey' not in response: # Last page
+			return
+		kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+# All YYYY-MM months from start through end (inclusive)
+def monthsBetween(start, end):
+	year, month = int(start[:4]), int(start[5:7])
+	while '{:04d}-{:02d}'.format(year, month) <= end[:7]:
+		yield '{:04d}-{:02d}'.format(year, month)
+		year, month = (year + 1, 1) if month == 12 else (year, month + 1)
 
 # Return all entries in the table that match a specific value within a field
+# Fields with an index (Date, BatchNumber, Tester) are queried on it; anything else falls back to a (paginated) scan
 # NOTE: this will not work with the primary key (serial number) but all other attributes will work
 def singleFieldScan(field, val):
 	try:
-		relevantEntries = table.scan( # Use scan when not working with the HASH key
-			FilterExpression = Attr(field).eq(val)
-		)['Items']
-		return relevantEntries
+		byField = {hashKey: name for name, (hashKey, rangeKey) in indexes.items() if name != 'MonthDateIndex'}
+		if field in byField:
+			yield from paginate(table.query, IndexName = byField[field], KeyConditionExpression = Key(field).eq(val))
+		else:
+			yield from paginate(table.scan, FilterExpression = Attr(field).eq(val)) # Use scan when not working with an indexed field
 	except Exception as e:
 		print("Error Encountered:", e)
 
@@ -199,21 +424,30 @@ def testSingleFieldScan():
 	for item in commonBatch:
 		print('Batch item:', item)
 
+# Entries for one batch/tester between 2 dates (inclusive)--a single query on the composite index
+def getBatchEntriesBetween(batchNum, start, end):
+	return paginate(table.query, IndexName = 'BatchDateIndex', KeyConditionExpression = Key('BatchNumber').eq(batchNum) & Key('Date').between(start, end))
+
+def getTesterEntriesBetween(tester, start, end):
+	return paginate(table.query, IndexName = 'TesterDateIndex', KeyConditionExpression = Key('Tester').eq(tester) & Key('Date').between(start, end))
 
-# Get all entries between 2 dates (inclusive)
+# Get all entries between 2 dates (inclusive)--one query per month partition of MonthDateIndex
 def getEntriesBetween(start, end): # Assume start and end are well-formatted strings
 	try:
-		relEntries = table.scan(
-			FilterExpression = Attr('Date').between(start, end)
-		)['Items']
-		return relEntries
+		for month in monthsBetween(start, end):
+			yield from paginate(table.query, IndexName = 'MonthDateIndex', KeyConditionExpression = Key('Month').eq(month) & Key('Date').between(start, end))
 	except Exception as e:
 		print('Unable to provide dates between')
 		print('Issue encountered:', e)
 
-# Get all entries before a specific date
+# Get all entries before a specific date (inclusive)
+# No lower bound means no known set of month partitions to query, so this one stays a (paginated) scan
 def getEntriesBefore(before):
-	return getEntriesBetween('0000-00-00', before)
+	try:
+		yield from paginate(table.scan, FilterExpression = Attr('Date').lte(before))
+	except Exception as e:
+		print('Unable to provide dates before', before)
+		print('Issue encountered:', e)
 
 # Get all entries after a specific date
 def getEntriesAfter(after):
@@ -221,37 +455,179 @@ def getEntriesAfter(after):
 
 # Query by specific year--assume in YY format
 def getYearEntries(date): # Date refers to a specific year
-	return getEntriesBetween(date + '-00-00', date + '-12-31')
+	return getEntriesBetween(date + '-01-01', date + '-12-31')
 # Query by specific month + year combination--input: YYYY-MM
 def getMonthEntries(date):
-	startDate = date + '-01'
-	endDate = date + '-31'
-	print('Start/End', startDate, endDate)
-	return getEntriesBetween(startDate, endDate)
+	try:
+		yield from paginate(table.query, IndexName = 'MonthDateIndex', KeyConditionExpression = Key('Month').eq(date))
+	except Exception as e:
+		print('Unable to fetch entries for month', date)
+		print('Issue encountered:', e)
 
 # Query by a specific date (month/day/year)
 def getDateEntries(date):
 	try:
-		relEntries = table.scan(
-			FilterExpression = Attr('Date').eq(date)
-		)
+		yield from paginate(table.query, IndexName = 'DateIndex', KeyConditionExpression = Key('Date').eq(date))
 	except Exception as e:
 		print('Encountered error when trying to fetch all entries by specific date')
 		print('Error:', e)
 
+# One-off: give entries written before MonthDateIndex existed their Month attribute
+def backfillMonth():
+	for item in paginate(table.scan, FilterExpression = Attr('Date').exists() & Attr('Month').not_exists(), ProjectionExpression = 'SerialNumber, #d', ExpressionAttributeNames = {'#d': 'Date'}):
+		table.update_item(
+			Key = {'SerialNumber': item['SerialNumber']},
+			UpdateExpression = 'SET #month = :month',
+			ExpressionAttributeNames = {'#month': 'Month'},
+			ExpressionAttributeValues = {':month': item['Date'][:7]}
+		)
+
+# Parallel scan--for exports/sweeps that really do need every item
+# The table is split into totalSegments pieces (Segment/TotalSegments) and each piece is scanned on its own thread
+# Output goes to sink(items) (called once per page) and/or to a local .jsonl/.parquet file
+# Progress is checkpointed per segment, so calling parallelScan again with the same checkpoint picks up where it stopped
+
+# Make DynamoDB values JSON friendly (numbers come back as Decimal, string sets as set)
+def jsonDefault(val):
+	if isinstance(val, Decimal):
+		return int(val) if val == val.to_integral_value() else float(val)
+	if isinstance(val, (set, frozenset)):
+		return sorted(val)
+	return str(val)
+
+def loadCheckpoint(path, totalSegments):
+	if path is None or not os.path.exists(path):
+		return {}
+	with open(path) as f:
+		saved = json.load(f)
+	if saved.get('totalSegments') != totalSegments: # Segments don't line up with the last run--can't resume
+		print('Checkpoint', path, 'was made with', saved.get('totalSegments'), 'segments--starting over')
+		return {}
+	return {int(seg): state for seg, state in saved['segments'].items()}
+
+def saveCheckpoint(path, totalSegments, segments):
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump({'totalSegments': totalSegments, 'segments': segments}, f, default = jsonDefault)
+	os.replace(tmp, path) # Atomic, so a crash mid-write never leaves a half written checkpoint
+
+# Scan one segment page by page: hand each page to the sink/part file, then record how far we got
+def scanSegment(segment, totalSegments, scanArgs, state, save, sink = None, partPath = None, rateLimit = None):
+	if state.get('done'):
+		return state['items']
+	kwargs = dict(scanArgs, Segment = segment, TotalSegments = totalSegments, ReturnConsumedCapacity = 'TOTAL')
+	if state.get('lastKey'):
+		kwargs['ExclusiveStartKey'] = state['lastKey']
+	part = None
+	if partPath is not None:
+		part = open(partPath, 'a+b')
+		part.truncate(state.get('offset', 0)) # Drop anything written after the last checkpoint (no duplicates on resume)
+		part.seek(0, os.SEEK_END)
+	started = time.monotonic()
+	consumed = 0.0
+	try:
+		while True:
+			response = table.meta.client.scan(**kwargs) # Low level client is thread safe (resources are not)
+			items = response['Items']
+			if part is not None and items:
+				part.write(''.join(json.dumps(item, default = jsonDefault) + '\n' for item in items).encode())
+				part.flush()
+			if sink is not None and items:
+				sink(items)
+			lastKey = response.get('LastEvaluatedKey')
+			state = {'lastKey': lastKey, 'done': lastKey is None, 'items': state.get('items', 0) + len(items), 'offset': part.tell() if part is not None else 0}
+			save(segment, state) # Only recorded once the page has been fully handled
+			if state['done']:
+				return state['items']
+			kwargs['ExclusiveStartKey'] = state['lastKey']
+			if rateLimit: # Read capacity units per second for this segment--sleep off anything used ahead of schedule
+				consumed += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+				time.sleep(max(0, started + consumed / rateLimit - time.monotonic()))
+	finally:
+		if part is not None:
+			part.close()
+
+# Stitch the per-segment part files into the final output file
+def combineParts(output, partPaths):
+	if output.endswith('.parquet'):
+		import pandas as pd # Only needed for Parquet output
+		frames = [pd.read_json(path, lines = True) for path in partPaths if os.path.getsize(path) > 0]
+		(pd.concat(frames, ignore_index = True) if frames else pd.DataFrame()).to_parquet(output, index = False)
+	else:
+		with open(output, 'wb') as out:
+			for path in partPaths:
+				with open(path, 'rb') as part:
+					out.write(part.read())
+	for path in partPaths:
+		os.remove(path)
+
+def parallelScan(totalSegments = 8, projection = None, filterExpr = None, sink = None, output = None, checkpoint = None, rateLimit = None, pageSize = None):
+	'''
+	totalSegments: number of segments (+ threads) to scan with
+	projection: list of attribute names to keep (None keeps whole items)
+	filterExpr: boto3 condition applied server side, ex: Attr('FunctionTest').ne('Pass')
+	sink: function called with each page of items (called from the worker threads, one page at a time)
+	output: .jsonl or .parquet file to write every item to
+	checkpoint: JSON file tracking each segment's progress (defaults to output + '.checkpoint' when writing a file)
+	rateLimit: max read capacity units per second for each segment
+	pageSize: max items evaluated per scan request
+	'''
+	scanArgs = {'TableName': table.name}
+	if projection:
+		scanArgs['ProjectionExpression'] = ', '.join('#p' + str(i) for i in range(len(projection))) # Placeholders since Date is a reserved word
+		scanArgs['ExpressionAttributeNames'] = {'#p' + str(i): name for i, name in enumerate(projection)}
+	if filterExpr is not None:
+		scanArgs['FilterExpression'] = filterExpr
+	if pageSize:
+		scanArgs['Limit'] = pageSize
+	if checkpoint is None and output is not None:
+		checkpoint = output + '.checkpoint'
+
+	segments = loadCheckpoint(checkpoint, totalSegments)
+	for seg in range(totalSegments):
+		segments.setdefault(seg, {})
+	lock = threading.Lock()
+	def save(seg, state):
+		with lock:
+			segments[seg] = state
+			if checkpoint is not None:
+				saveCheckpoint(checkpoint, totalSegments, segments)
+	sinkLock = threading.Lock()
+	def lockedSink(items): # Callers don't need to worry about pages arriving from several threads at once
+		with sinkLock:
+			sink(items)
+
+	partPaths = [output + '.part' + str(seg) for seg in range(totalSegments)] if output is not None else [None] * totalSegments
+	start = time.time()
+	with concurrent.futures.ThreadPoolExecutor(max_workers = totalSegments) as pool:
+		futures = [pool.submit(scanSegment, seg, totalSegments, scanArgs, segments[seg], save, lockedSink if sink else None, partPaths[seg], rateLimit) for seg in range(totalSegments)]
+		try:
+			total = sum(f.result() for f in futures)
+		except Exception as e:
+			print('Scan interrupted--run again with the same checkpoint to resume')
+			print('Error:', e)
+			raise
+	if output is not None:
+		combineParts(output, partPaths)
+	if checkpoint is not None and os.path.exists(checkpoint): # Finished, so the next export starts fresh
+		os.remove(checkpoint)
+	seconds = time.time() - start
+	print('Scanned', total, 'items in', round(seconds, 2), 'seconds with', totalSegments, 'segments')
+	return {'items': total, 'seconds': seconds}
+
 # Get only entries with error
-def getErrorEntries():
-	return singleFieldScan('Function Test', 'Pass') # Use the helper method defined above
+def getErrorEntries(totalSegments = 4):
+	errors = []
+	parallelScan(totalSegments, filterExpr = Attr('FunctionTest').ne('Pass'), sink = errors.extend)
+	return errors
 
 # Test the date methods above
 def addMoreDates():
 	pivot = '2021-06-01'
 	before = '2021-05-29'
 	after = '2021-06-02'
-	for i in range(15):
-		sn = '38383JSBA0-dateChange' + str(i)
-		addEntry('QAResults', sn, 5, 'Zachary', 'Pass', 'Completed test results on 6-3-2021')
-		editEntry(sn, 'Date', before if i % 2 == 0 else after)
+	items = [makeItem('38383JSBA0-dateChange' + str(i), 5, 'Zachary', 'Pass', 'Completed test results on 6-3-2021', before if i % 2 == 0 else after) for i in range(15)]
+	batchWriteItems(items) # Date set up front--one write per entry instead of put + update
 
 def testDateFramework():
 	betweenEntries = getEntriesBetween('2021-05-29', '2021-06-02')
@@ -269,10 +645,7 @@ def testDateFramework():
 
 def makeMoreDates():
 	dates = ['2020-05-22', '2020-05-22', '2019-04-02', '2019-06-21', '2020-05-02']
-	for i in range(20):
-		sn = 'prefix-start-' + str(i)
-		addEntry('QAResults', sn, 5, 'MiiTester', 'Pass', 'Completed test results on time')
-		editEntry(sn, 'Date', dates[i % 5])
+	batchWriteItems([makeItem('prefix-start-' + str(i), 5, 'MiiTester', 'Pass', 'Completed test results on time', dates[i % 5]) for i in range(20)])
 
 
 def testMoreDateFunctions():
@@ -360,41 +733,162 @@ def testSQL():
 	#r2 = client.execute_statement(Statement = q2)
 
 def makeMoreBatches():
-	for i in range(10):
-		addEntry('QAResults', 'ztzhu' + str(i), 10, 'Hippy', 'Pass', 'Completed test results on 6-3-2021')
-
-	for i in range(10):
-		addEntry('QAResults', 'ztzhu2' + str(i), 15, 'Hippy22', 'Neither', 'New Message')
+	items = [makeItem('ztzhu' + str(i), 10, 'Hippy', 'Pass', 'Completed test results on 6-3-2021') for i in range(10)]
+	items += [makeItem('ztzhu2' + str(i), 15, 'Hippy22', 'Neither', 'New Message') for i in range(10)]
+	batchWriteItems(items)
 	print('Able to add more entries for makeMoreBatches!')
 
 
+# Bulk update/delete by predicate
+# PartiQL writes need the full key, so "UPDATE ... where BatchNumber = 10" can't run as one statement
+# Instead: find the matching serial numbers (index query when a predicate field is indexed, parallel scan otherwise),
+# then send one keyed statement per entry through BatchExecuteStatement, 25 statements per request, across threads
+
+batchStatementSize = 25
+serializer = TypeSerializer() # Plain python values --> {'S': ...}/{'N': ...} for the low level client
+
+# Turn a predicate into a boto3 condition--predicates are {field: value} (all must match) or a ready made condition
+def predicateCondition(predicate):
+	if not isinstance(predicate, dict):
+		return predicate
+	condition = None
+	for field, val in predicate.items():
+		condition = Attr(field).eq(val) if condition is None else condition & Attr(field).eq(val)
+	return condition
+
+# Serial numbers of every entry matching the predicate
+def matchingKeys(predicate, totalSegments = 8):
+	if isinstance(predicate, dict):
+		for name, (hashKey, rangeKey) in indexes.items():
+			if hashKey not in predicate:
+				continue
+			keyCondition = Key(hashKey).eq(predicate[hashKey])
+			if rangeKey in predicate:
+				keyCondition = keyCondition & Key(rangeKey).eq(predicate[rangeKey])
+			rest = {f: v for f, v in predicate.items() if f not in (hashKey, rangeKey)}
+			kwargs = {'IndexName': name, 'KeyConditionExpression': keyCondition}
+			if rest:
+				kwargs['FilterExpression'] = predicateCondition(rest)
+			return [item['SerialNumber'] for item in paginate(table.query, **kwargs)]
+	keys = []
+	parallelScan(totalSegments, projection = ['SerialNumber'], filterExpr = predicateCondition(predicate), sink = lambda items: keys.extend(item['SerialNumber'] for item in items))
+	return keys
+
+# Build the keyed statement (+ parameters) for one entry
+# condition: {field: value} that must still hold when the write happens--otherwise that entry fails with ConditionalCheckFailed
+def keyedStatement(SN, updates = None, condition = None):
+	params = []
+	if updates is not None:
+		updates = dict(updates)
+		if 'Date' in updates: # Keep Month in sync, same as editEntry
+			updates['Month'] = updates['Date'][:7]
+		setClause = ', '.join('"{}" = ?'.format(field) for field in updates)
+		params += list(updates.values())
+		statement = 'UPDATE "{}" SET {} WHERE "SerialNumber" = ?'.format(table.name, setClause)
+	else:
+		statement = 'DELETE FROM "{}" WHERE "SerialNumber" = ?'.format(table.name)
+	params.append(SN)
+	for field, val in (condition or {}).items():
+		statement += ' AND "{}" = ?'.format(field)
+		params.append(val)
+	return {'Statement': statement, 'Parameters': [serializer.serialize(p) for p in params]}
+
+# Send one group of statements, retrying statements that were throttled
+# Returns (number applied, [{'SerialNumber', 'code', 'message'}] for entries that failed)
+def runStatements(group, maxRetries = 8):
+	pending = group # [(SN, statement)] still to send
+	failed = []
+	for attempt in range(maxRetries + 1):
+		try:
+			responses = client.batch_execute_statement(Statements = [statement for SN, statement in pending])['Responses']
+		except ClientError as e:
+			if e.response['Error']['Code'] not in throttleErrors: # The whole request was rejected (ex: bad statement)
+				failed += [{'SerialNumber': SN, 'code': e.response['Error']['Code'], 'message': str(e)} for SN, statement in pending]
+				return len(group) - len(failed), failed
+			backoff(attempt)
+			continue
+		retry = []
+		for (SN, statement), response in zip(pending, responses): # Responses line up with the statements sent
+			error = response.get('Error')
+			if error is None:
+				continue
+			if error.get('Code') in ('ProvisionedThroughputExceeded', 'ThrottlingError', 'RequestLimitExceeded'):
+				retry.append((SN, statement))
+			else:
+				failed.append({'SerialNumber': SN, 'code': error.get('Code'), 'message': error.get('Message')})
+		pending = retry
+		if not pending:
+			return len(group) - len(failed), failed
+		backoff(attempt)
+	failed += [{'SerialNumber': SN, 'code': 'Throttled', 'message': 'Still throttled after {} retries'.format(maxRetries)} for SN, statement in pending]
+	return len(group) - len(failed), failed
+
+'''
+predicate: {field: value} to match (ex: {'BatchNumber': 10}) or a boto3 condition (ex: Attr('Tester').begins_with('Ray'))
+updates: {field: new value} to SET on every match (None deletes the matches instead)
+condition: True re-checks a {field: value} predicate at write time (so entries edited since the lookup are left alone),
+	or pass your own {field: value} check
+dryRun: only find + report the matches, nothing is written
+Returns {'matched', 'applied', 'failed', 'seconds'}
+'''
+def bulkWriteWhere(predicate, updates = None, condition = True, dryRun = False, threads = 4, progressEvery = 10):
+	start = time.time()
+	keys = matchingKeys(predicate)
+	if condition is True:
+		condition = predicate if isinstance(predicate, dict) else None
+	statements = [(SN, keyedStatement(SN, updates, condition)) for SN in keys]
+	result = {'matched': len(keys), 'applied': 0, 'failed': []}
+	if dryRun:
+		print('Dry run:', len(keys), 'entries would be', 'updated' if updates is not None else 'deleted')
+		if statements:
+			print('Example statement:', statements[0][1]['Statement'], [p for p in statements[0][1]['Parameters']])
+		result['seconds'] = time.time() - start
+		return result
+	groups = [statements[i:i + batchStatementSize] for i in range(0, len(statements), batchStatementSize)]
+	with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as pool:
+		futures = [pool.submit(runStatements, group) for group in groups]
+		for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+			applied, failed = future.result()
+			result['applied'] += applied
+			result['failed'] += failed
+			if progressEvery and (done % progressEvery == 0 or done == len(groups)):
+				print('Progress: {}/{} groups, {} applied, {} failed'.format(done, len(groups), result['applied'], len(result['failed'])))
+	entryCache.invalidate(*keys)
+	result['seconds'] = time.time() - start
+	print('Matched', result['matched'], 'entries, applied', result['applied'], 'in', round(result['seconds'], 2), 'seconds')
+	return result
+
+def bulkUpdateWhere(predicate, updates, condition = True, dryRun = False, threads = 4):
+	return bulkWriteWhere(predicate, updates, condition, dryRun, threads)
+
+def bulkDeleteWhere(predicate, condition = True, dryRun = False, threads = 4):
+	return bulkWriteWhere(predicate, None, condition, dryRun, threads)
+
 def testBatch():
-	q1 = "UPDATE QAResults SET Tester = 'Fake Hippy' where BatchNumber = '10'"
-	#q1 = "SELECT * FROM QAResults where contains(Tester, 'Ray')"
-	r1 = client.execute_transaction(TransactStatements = [{'Statement':q1}])
+	bulkUpdateWhere({'BatchNumber': 10}, {'Tester': 'Fake Hippy'}) # Was: UPDATE QAResults SET Tester = 'Fake Hippy' where BatchNumber = '10'
 	print('Executed batch1!')
 
-	# q2 = "DELETE FROM QAResults where BatchNumber = '15'"
-	# r2 = client.execute_transaction(TransactStatements = [q2])
-	# print('Executed batch2!')
+	bulkDeleteWhere({'BatchNumber': 15}, dryRun = True) # Was: DELETE FROM QAResults where BatchNumber = '15'
+	print('Executed batch2!')
 # Testing the partiQL operations with 
 def testTransactions():
 	return
 
-testAddEntry()
-testDeleteEntry()
-testEditEntry()
-testDeleteField()
-populateEntries(20)
-makeMoreBatches()
-# testSingleFieldScan()
-# testDateFramework()
-# testSQL()
-# testBatch()
-addMoreDates()
-makeMoreDates()
-#testDateFramework()
-testMoreDateFunctions()
+if __name__ == '__main__': # Only run the test drivers when executed directly (so the helpers can be imported, ex: under moto)
+	testAddEntry()
+	testDeleteEntry()
+	testEditEntry()
+	testDeleteField()
+	populateEntries(20)
+	makeMoreBatches()
+	# testSingleFieldScan()
+	# testDateFramework()
+	# testSQL()
+	# testBatch()
+	addMoreDates()
+	makeMoreDates()
+	#testDateFramework()
+	testMoreDateFunctions()
 '''
 TODO's
 - Brainstorm other queries that might be relevant before single serial number, date between/before/after + matching an exact field
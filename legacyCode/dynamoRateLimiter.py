@@ -0,0 +1,184 @@
+# Client side rate limiting for DynamoDB tables with provisioned capacity
+# Hooks into a boto3 client/resource (via botocore events), so existing put_item/query/scan/batch calls get paced without changes:
+#   before each call: take the estimated capacity units from a token bucket (sleeps if the bucket is empty)
+#   after each call: settle up with the real number from ReturnConsumedCapacity
+#   on ProvisionedThroughputExceededException: halve the rate (multiplicative decrease), then creep back up while calls succeed (additive increase)
+import re
+import threading
+import time
+
+readOps = {'GetItem': 1, 'BatchGetItem': 1, 'Query': 1, 'Scan': 1}
+writeOps = {'PutItem': 1, 'UpdateItem': 1, 'DeleteItem': 1, 'BatchWriteItem': 1}
+partiQLOps = ['ExecuteStatement', 'BatchExecuteStatement']
+throttleErrors = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+statementTable = re.compile(r'\b(?:from|into|update)\s+"?([\w.-]+)"?', re.IGNORECASE) # Table name in a PartiQL statement
+
+class TokenBucket:
+	def __init__(self, rate, maxRate = None, minRate = None, increase = None):
+		'''
+		rate: capacity units per second to start at
+		maxRate: ceiling for the additive increase (defaults to rate--the provisioned throughput)
+		minRate: floor for the multiplicative decrease
+		increase: units/second added back for each second without throttling
+		'''
+		self.rate = float(rate)
+		self.maxRate = float(maxRate or rate)
+		self.minRate = float(minRate or max(0.5, self.maxRate * 0.05))
+		self.increase = float(increase or max(0.5, self.maxRate * 0.1))
+		self.tokens = self.rate # Start with one second worth of burst
+		self.last = time.monotonic()
+		self.lastIncrease = self.last
+		self.lock = threading.Lock()
+		self.stats = {'consumed': 0.0, 'throttles': 0, 'waited': 0.0}
+
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) # Burst is capped at one second worth
+		self.last = now
+
+	# Take n units--the bucket can go into debt (ex: a 25 item batch on a 5 WCU table), the caller then waits it off
+	def acquire(self, n):
+		with self.lock:
+			self.refill()
+			self.tokens -= n
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+			self.stats['waited'] += wait
+		if wait:
+			time.sleep(wait)
+
+	# Correct the estimate once the real consumed capacity is known (positive delta = used more than estimated)
+	def settle(self, estimate, actual):
+		with self.lock:
+			self.tokens -= actual - estimate
+			self.stats['consumed'] += actual
+			now = time.monotonic()
+			if now - self.lastIncrease >= 1 and self.rate < self.maxRate: # Additive increase, at most once per second
+				self.rate = min(self.maxRate, self.rate + self.increase)
+				self.lastIncrease = now
+
+	def throttled(self):
+		with self.lock:
+			self.rate = max(self.minRate, self.rate / 2) # Multiplicative decrease
+			self.tokens = min(self.tokens, 0)
+			self.lastIncrease = time.monotonic()
+			self.stats['throttles'] += 1
+
+class CapacityLimiter:
+	def __init__(self, burst = 1.0, rates = None):
+		'''
+		burst: multiplier on the provisioned throughput for the rate ceiling (1 = stay at the provisioned rate)
+		rates: optional {(tableName, indexName or None, 'read'/'write'): units per second} overrides--skips describe_table
+		'''
+		self.burst = burst
+		self.buckets = dict((key, TokenBucket(rate * burst)) for key, rate in (rates or {}).items())
+		self.configured = set(key[0] for key in self.buckets)
+		self.lock = threading.Lock()
+		self.client = None
+
+	# Hook into a boto3 client or resource (anything using the same client shares the limiter, ex: every ddb.Table)
+	def attach(self, *clients):
+		for c in clients:
+			c = getattr(c, 'meta', None) and getattr(c.meta, 'client', None) or c # Resource --> its client
+			self.client = self.client or c
+			events = c.meta.events
+			events.register('before-parameter-build.dynamodb', self.beforeCall, unique_id = 'capacityLimiter-before')
+			events.register('after-call.dynamodb', self.afterCall, unique_id = 'capacityLimiter-after')
+			events.register('needs-retry.dynamodb', self.onRetry, unique_id = 'capacityLimiter-retry')
+		return self
+
+	# Read the table's provisioned throughput (on-demand tables have none, so they're left unlimited)
+	def configure(self, tableName):
+		with self.lock:
+			if tableName in self.configured:
+				return
+			self.configured.add(tableName)
+		try:
+			desc = self.client.describe_table(TableName = tableName)['Table']
+		except Exception as e:
+			print('Unable to read throughput for', tableName, '- not rate limiting it')
+			print('Exception:', e)
+			return
+		indexes = desc.get('GlobalSecondaryIndexes', [])
+		read = desc.get('ProvisionedThroughput', {}).get('ReadCapacityUnits', 0)
+		writes = [desc.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)]
+		writes += [i.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0) for i in indexes] # Every write also lands in each index
+		with self.lock:
+			if read:
+				self.buckets[(tableName, None, 'read')] = TokenBucket(read * self.burst)
+			if min(writes):
+				self.buckets[(tableName, None, 'write')] = TokenBucket(min(writes) * self.burst)
+			for i in indexes:
+				indexRead = i.get('ProvisionedThroughput', {}).get('ReadCapacityUnits', 0)
+				if indexRead:
+					self.buckets[(tableName, i['IndexName'], 'read')] = TokenBucket(indexRead * self.burst)
+
+	# Work out which buckets a call draws from + how many units to take up front: [(bucket key, estimate)]
+	def charges(self, op, params):
+		if op in readOps or op in writeOps:
+			kind = 'read' if op in readOps else 'write'
+			if op == 'BatchGetItem':
+				return [((tbl, None, kind), len(req.get('Keys', [])) * 0.5) for tbl, req in params.get('RequestItems', {}).items()]
+			if op == 'BatchWriteItem':
+				return [((tbl, None, kind), len(reqs)) for tbl, reqs in params.get('RequestItems', {}).items()]
+			estimate = 0.5 if kind == 'read' else 1 # Eventually consistent read of a small item / write of an item under 1KB
+			return [((params.get('TableName'), params.get('IndexName'), kind), estimate)]
+		if op in partiQLOps:
+			statements = params.get('Statements') or [params]
+			found = []
+			for s in statements:
+				match = statementTable.search(s.get('Statement', ''))
+				if match:
+					kind = 'read' if s['Statement'].lstrip().upper().startswith('SELECT') else 'write'
+					found.append(((match.group(1), None, kind), 0.5 if kind == 'read' else 1))
+			return found
+		return [] # Control plane calls (describe_table, create_table...) aren't limited
+
+	def beforeCall(self, params, model, context, **kwargs):
+		charges = [c for c in self.charges(model.name, params) if c[0][0]]
+		for key, estimate in charges:
+			self.configure(key[0])
+		charges = [(key, estimate) for key, estimate in charges if key in self.buckets]
+		if not charges:
+			return
+		if model.name not in partiQLOps:
+			params.setdefault('ReturnConsumedCapacity', 'INDEXES') # So the real cost can be settled afterwards
+		for key, estimate in charges:
+			self.buckets[key].acquire(estimate)
+		context['capacityLimiter'] = charges
+
+	def afterCall(self, parsed, context, **kwargs):
+		charges = context.get('capacityLimiter')
+		if not charges or 'Error' in parsed:
+			return
+		consumed = parsed.get('ConsumedCapacity')
+		if isinstance(consumed, dict):
+			consumed = [consumed]
+		if not consumed: # PartiQL calls don't report capacity--keep the estimate
+			for key, estimate in charges:
+				self.buckets[key].settle(estimate, estimate)
+			return
+		for key, estimate in charges:
+			actual = 0.0
+			for c in consumed:
+				if c.get('TableName') != key[0]:
+					continue
+				if key[1] is not None: # Query/scan on an index
+					actual += c.get('GlobalSecondaryIndexes', {}).get(key[1], {}).get('CapacityUnits', c.get('CapacityUnits', 0))
+				else:
+					actual += c.get('Table', {}).get('CapacityUnits', c.get('CapacityUnits', 0))
+			self.buckets[key].settle(estimate, actual)
+
+	# botocore is about to decide whether to retry--on a throttle, back the rate off + wait for tokens before the retry goes out
+	def onRetry(self, response, request_dict, **kwargs):
+		charges = (request_dict.get('context') or {}).get('capacityLimiter')
+		if not charges or response is None:
+			return None
+		code = response[1].get('Error', {}).get('Code')
+		if code in throttleErrors:
+			for key, estimate in charges:
+				self.buckets[key].throttled()
+				self.buckets[key].acquire(estimate)
+		return None # Let botocore's own retry handler pick the delay
+
+	def stats(self):
+		return dict(('/'.join(str(k) for k in key if k is not None), dict(bucket.stats, rate = bucket.rate)) for key, bucket in self.buckets.items())
@@ -0,0 +1,187 @@
+# Database layer shared by the QAResults notebooks (QAResultsBackend-Official, IntegrateLegacyData)
+# Connection pool (reusable connections so each statement only costs a cursor round trip) + bulk inserts through it
+import contextlib
+import itertools
+import sys
+import threading
+import time
+
+import pandas as pd
+
+class ConnectionPool:
+    def __init__(self, connect, size = 5, timeout = 30, maxIdle = 60, ping = 'SELECT 1'):
+        '''
+        connect: zero-argument function that opens a new DB-API connection (aurora_data_api, pymysql, sqlite3...)
+        size: max number of connections that can be open at once
+        timeout: seconds to wait for a free connection before giving up
+        maxIdle: connections that sat unused for longer than this (seconds) get health checked before reuse
+        ping: cheap statement used for the health check
+        '''
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.ping = ping
+        self.idle = [] # Stack of (connection, time last returned)--most recently used connection goes out first
+        self.opened = 0 # Connections currently open (idle + checked out)
+        self.cond = threading.Condition() # Guards idle/opened + lets threads wait for a free connection
+        self.stats = {'opened': 0, 'reused': 0, 'reconnects': 0}
+
+    # Run the ping statement to make sure the connection is still usable
+    def isHealthy(self, conn):
+        try:
+            cur = conn.cursor()
+            cur.execute(self.ping)
+            cur.fetchall()
+            return True
+        except Exception:
+            return False
+
+    # Open a brand new connection (the slot has already been reserved in self.opened)
+    def open(self):
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.cond:
+                self.opened -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.stats['opened'] += 1
+        return conn
+
+    # Close a connection that shouldn't be reused + free up its slot
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.cond:
+            self.opened -= 1
+            self.cond.notify()
+
+    # Get a connection: reuse an idle one if possible, otherwise open one (or wait if the pool is full)
+    def checkout(self):
+        deadline = time.monotonic() + self.timeout
+        with self.cond:
+            while not self.idle and self.opened >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('No free connection after {} seconds'.format(self.timeout))
+                self.cond.wait(remaining)
+            if not self.idle: # Room for another connection
+                self.opened += 1
+                conn = None
+            else:
+                conn, lastUsed = self.idle.pop()
+        if conn is None:
+            return self.open()
+        if time.monotonic() - lastUsed > self.maxIdle and not self.isHealthy(conn): # Stale handle--swap it out
+            self.discard(conn)
+            with self.cond:
+                self.stats['reconnects'] += 1
+            return self.checkout()
+        with self.cond:
+            self.stats['reused'] += 1
+        return conn
+
+    # Return a connection to the pool once done with it
+    def checkin(self, conn):
+        with self.cond:
+            self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    # Hand back a connection after a failure: keep it if it still works, otherwise throw it away
+    def release(self, conn):
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        if self.isHealthy(conn):
+            self.checkin(conn)
+            return True
+        self.discard(conn)
+        return False
+
+    # Borrow a connection for a with-block (ex: pd.read_sql)
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn)
+            raise
+        self.checkin(conn)
+
+    # Call work(conn) on a pooled connection
+    # idempotent: work is safe to run twice (reads, upserts)--if the connection died underneath it, it's retried on a fresh one
+    # Writes that aren't idempotent are never retried: the connection may have died after the server applied them
+    def run(self, work, retries = 1, idempotent = False):
+        for attempt in range(retries + 1):
+            conn = self.checkout()
+            try:
+                result = work(conn)
+            except Exception:
+                if self.release(conn) or not idempotent or attempt == retries: # Connection is fine (so the statement itself failed), or not safe to repeat
+                    raise
+                with self.cond:
+                    self.stats['reconnects'] += 1
+                continue
+            self.checkin(conn)
+            return result
+
+    # Close every idle connection (ex: before shutting down the kernel)
+    def closeAll(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for conn, lastUsed in idle:
+            self.discard(conn)
+
+# Placeholder for a bound parameter in whatever style the driver expects (pymysql: %(name)s, aurora_data_api/sqlite3: :name)
+def paramPlaceholder(db, name):
+    driver = sys.modules[type(db).__module__.split('.')[0]]
+    if getattr(driver, 'paramstyle', 'named') == 'pyformat':
+        return '%({})s'.format(name)
+    return ':' + name
+
+# Columns of QAResults in table order (bulk inserts bind values by these names--rows missing trailing columns get NULL)
+qaColumns = ['SerialNumber', 'BatchNumber', 'Date', 'Tester', 'FunctionalTest', 'FailureType', 'LogMessage', 'DeviceType']
+
+# Tail that turns an insert into an upsert (rows whose key already exists get overwritten instead of failing)
+def upsertClause(db, columns, key = 'SerialNumber'):
+    updates = [col for col in columns if col != key]
+    if type(db).__module__.split('.')[0] == 'sqlite3':
+        return ' on conflict({}) do update set {}'.format(key, ', '.join('{0} = excluded.{0}'.format(col) for col in updates))
+    return ' on duplicate key update {}'.format(', '.join('{0} = values({0})'.format(col) for col in updates)) # MySQL (pymysql, aurora_data_api)
+
+# Insert lots of rows at once--one parameterized executemany (+ one transaction) per chunk instead of a round trip per row
+# pool: ConnectionPool to write through
+# rows: DataFrame with the table's column names, or an iterable of tuples (in column order) / dicts
+# upsert: overwrite rows whose key (SerialNumber) is already in the table (safe to re-run) instead of failing the chunk
+# Returns {'inserted': # of rows written, 'failed': [{'chunk', 'startRow', 'rows', 'error'}, ...]} so failed chunks can be retried
+def bulkInsertEntries(pool, rows, chunkSize = 500, tbl = 'QAResults', columns = qaColumns, upsert = False, key = 'SerialNumber'):
+    if isinstance(rows, pd.DataFrame):
+        frame = rows.reindex(columns = columns).astype(object) # Columns the frame doesn't have --> NULL
+        rows = frame.where(frame.notna(), None).itertuples(index = False, name = None) # NaN --> NULL
+    records = (row if isinstance(row, dict) else dict(zip(columns, row)) for row in rows)
+    result = {'inserted': 0, 'failed': []}
+    chunkNum = 0
+    while True:
+        chunk = [{col: r.get(col) for col in columns} for r in itertools.islice(records, chunkSize)]
+        if not chunk:
+            break
+        def insertChunk(db):
+            q = ''' Insert into {} ({}) values ({}) '''.format(tbl, ', '.join(columns), ', '.join(paramPlaceholder(db, col) for col in columns))
+            if upsert:
+                q += upsertClause(db, columns, key)
+            c = db.cursor()
+            c.executemany(q, chunk) # Driver sends the whole chunk in one go (multi-row VALUES / batch statement)
+            db.commit() # One transaction per chunk--a bad row only fails its own chunk
+        try:
+            pool.run(insertChunk, idempotent = upsert) # Plain inserts aren't retried--the chunk may already be in
+            result['inserted'] += len(chunk)
+        except Exception as e:
+            result['failed'].append({'chunk': chunkNum, 'startRow': chunkNum * chunkSize, 'rows': chunk, 'error': e})
+        chunkNum += 1
+    return result